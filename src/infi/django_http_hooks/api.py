@@ -1,8 +1,24 @@
+from collections import OrderedDict
 from django.contrib.contenttypes.models import ContentType
-from infi.django_http_hooks.hooks.models import Hook, Signal
-from infi.django_http_hooks.utils import dynamic_import
+from django.db.models import Count, Min
+from django.utils import timezone
+from infi.django_http_hooks.hooks.models import Hook, Signal, Callback
+from infi.django_http_hooks.utils import dynamic_import, collect_callbacks
 from .exceptions import *
 
+# signal objects by their full path, each signal is imported once
+_signals = {}
+
+
+def resolve_signal(signal):
+    '''returns the signal object of the given signal path, or None if it cannot be imported'''
+    s = _signals.get(signal)
+    if s is None:
+        s = dynamic_import(signal)
+        if s is not None:
+            _signals[signal] = s
+    return s
+
 
 def create_signal(signal, create=True, **kwargs):
     '''
@@ -13,7 +29,7 @@ def create_signal(signal, create=True, **kwargs):
     :return: A Signal object if created, otherwise returns the object of the given Signal path
     '''
 
-    s = dynamic_import(signal)
+    s = resolve_signal(signal)
     if not s:
         raise InvalidSignalError()
 
@@ -35,6 +51,13 @@ def create_hook(signals, model=None, **kwargs):
                 content_type     =kwargs.get('content_type'),
                 name             =kwargs.get('name'),
                 enabled          =kwargs.get('enabled', True))
+    # any other field of the hook (e.g. payload_validation) can be given as well
+    for field in Hook._meta.concrete_fields:
+        if field.name in kwargs and field.name != 'model':
+            setattr(hook, field.name, kwargs[field.name])
+    if hook.payload_validation == 'on_save':
+        # its payloads are never validated per event, so the hook is validated like in the admin page
+        hook.clean()
     hook.save()
     for signal in signals:
         signal_ = create_signal(signal, create=True)
@@ -43,6 +66,45 @@ def create_hook(signals, model=None, **kwargs):
     return hook
 
 
+def emit_hook_events(instances, signal='django.db.models.signals.post_save', **kwargs):
+    '''
+    Create the callbacks of a batch of instances which were changed without sending signals, e.g. by QuerySet.bulk_create or QuerySet.update.
+    Callbacks are created for the hooks registered to the model of each instance and the given signal, and are inserted in bulk
+    :param instances: Iterable of model instances (e.g. a queryset of the updated rows)
+    :param signal: Full path of the signal which the hooks are registered to
+    :param kwargs: Additional inputs as would be sent by the signal, e.g. created=True
+    '''
+    from .hooks.signals import handler
+    with collect_callbacks():
+        for instance in instances:
+            handler(type(instance), signal, instance=instance, **kwargs)
+
+
+def get_callback_stats(since=None):
+    '''
+    returns the statistics of the callbacks of each hook by a single grouped query: the number of callbacks by status, the age in seconds
+    of the oldest waiting callback and the error rate (failed callbacks out of the sent and failed ones)
+    :param since: count only callbacks updated since this time
+    '''
+    queryset = Callback.objects.all()
+    if since:
+        queryset = queryset.filter(update_datetime__gt=since)
+    rows = queryset.values('hook_id', 'hook__name', 'status').annotate(count=Count('id'), oldest=Min('create_datetime')).order_by('hook_id')
+    now_ = timezone.now()
+    stats = OrderedDict()
+    for row in rows:
+        hook_stats = stats.setdefault(row['hook_id'], dict(hook_id=row['hook_id'], hook=row['hook__name'], counts={},
+                                                           oldest_waiting_age=None, error_rate=None))
+        hook_stats['counts'][row['status']] = row['count']
+        if row['status'] == 'waiting' and row['oldest']:
+            hook_stats['oldest_waiting_age'] = (now_ - row['oldest']).total_seconds()
+    for hook_stats in stats.values():
+        done = hook_stats['counts'].get('sent', 0) + hook_stats['counts'].get('error', 0)
+        if done:
+            hook_stats['error_rate'] = hook_stats['counts'].get('error', 0) / done
+    return list(stats.values())
+
+
 def init():
     from .hooks.signals import init_hooks
     return init_hooks()
\ No newline at end of file
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+import httpx
+from infi.django_http_hooks.dispatcher import Dispatcher, Outcome, DEFAULT_MAX_THROTTLE_WAIT
+from infi.django_http_hooks.http_requests import get_host, get_request_headers
+
+# number of requests sent at the same time by default. Requests are cheap coroutines, so many more of them are sent than threads
+DEFAULT_ASYNC_CONCURRENCY = 100
+
+
+class AsyncDispatcher(Dispatcher):
+    '''
+    Sends the requests of the callbacks by asyncio, using an httpx client per target host which keeps up to pool_size open connections.
+    The event loop runs in a thread of its own, while the requests are scheduled and the callbacks are updated in the calling thread,
+    exactly like by the threads of Dispatcher. Up to concurrency requests are sent at the same time.
+    '''
+
+    def __init__(self, concurrency=DEFAULT_ASYNC_CONCURRENCY, pool_size=None, max_throttle_wait=DEFAULT_MAX_THROTTLE_WAIT, http2=False):
+        super(AsyncDispatcher, self).__init__(concurrency=concurrency or DEFAULT_ASYNC_CONCURRENCY, pool_size=pool_size,
+                                              max_throttle_wait=max_throttle_wait)
+        if http2:
+            # httpx supports HTTP/2 only with the h2 package
+            import h2  # noqa: F401
+        self.http2 = http2
+        self.pool_size = pool_size or self.concurrency
+        self.loop = None
+        self._thread = None
+        self._clients = {}
+        self._semaphore = None
+
+    def _start(self):
+        '''start the event loop, which is kept between runs so the connections are kept open'''
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self.loop.run_forever, name='callbacks-event-loop')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _send_pending(self, pending, run_time, stats):
+        self._start()
+        self._schedule(pending, lambda request: asyncio.run_coroutine_threadsafe(self._deliver_async(request), self.loop), run_time, stats)
+
+    def _get_client(self, url):
+        '''returns the client of the host of the given url. Called by the event loop only'''
+        host = get_host(url)
+        client = self._clients.get(host)
+        if client is None:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            client = self._clients[host] = httpx.AsyncClient(limits=limits, http2=self.http2)
+        return client
+
+    async def _deliver_async(self, request):
+        '''sends the given request, the same as Dispatcher._deliver. Being called by the event loop so must not touch the database'''
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            start = time.time()
+            connect_timeout, read_timeout, total_timeout = request['timeouts']
+            try:
+                return await asyncio.wait_for(self._request(request, httpx.Timeout(read_timeout, connect=connect_timeout), start), total_timeout)
+            except asyncio.TimeoutError:
+                return Outcome(None, 'Request exceeded the total timeout of {} seconds'.format(total_timeout), time.time() - start, None)
+            except httpx.HTTPError as e:
+                # the messages of some httpx errors (e.g. timeouts) are empty
+                error = '{}: {}'.format(type(e).__name__, e) if str(e) else type(e).__name__
+                return Outcome(None, error, time.time() - start, None)
+
+    async def _request(self, request, timeout, start):
+        client = self._get_client(request['url'])
+        async with client.stream(request['method'], request['url'],
+                                 headers=get_request_headers(request['headers'], request['content_type']),
+                                 content=request['payload'],
+                                 timeout=timeout) as res:
+            # only the beginning of the response body is kept, for the status details, and the rest is dropped up to max_drain_bytes.
+            # A response which is read to its end returns its connection to the pool, otherwise the connection is closed
+            limit = max(self.max_response_bytes, self.max_drain_bytes)
+            body = b''
+            read = 0
+            async for chunk in res.aiter_bytes():
+                read += len(chunk)
+                if len(body) <= self.max_response_bytes:
+                    body += chunk[:self.max_response_bytes + 1 - len(body)]
+                if read > limit:
+                    break
+            if not res.is_error:
+                return Outcome(res.status_code, None, time.time() - start, None)
+            error = '{} {} for url: {}'.format(res.status_code, res.reason_phrase, request['url'])
+            return Outcome(res.status_code, error, time.time() - start, body[:self.max_response_bytes].decode('utf-8', errors='replace'))
+
+    async def _close_clients(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients = {}
+
+    def close(self):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self._close_clients(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self.loop = None
+        super(AsyncDispatcher, self).close()
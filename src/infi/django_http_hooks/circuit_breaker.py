@@ -0,0 +1,97 @@
+import time
+from logging import getLogger
+from django.conf import settings
+from django.core.cache import cache
+
+logger = getLogger(__name__)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 60
+BREAKER_CACHE_KEY = 'django_http_hooks:circuit_breaker:{}'
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+def get_breaker_settings():
+    '''returns the DJANGO_HTTP_HOOKS_CIRCUIT_BREAKER setting, or None when the circuit breaker is switched off (the default)'''
+    return getattr(settings, 'DJANGO_HTTP_HOOKS_CIRCUIT_BREAKER', None)
+
+
+def is_host_failure(outcome):
+    '''a request fails its host if it got no response (e.g. connection error or timeout) or a server error response'''
+    return outcome.error is not None and (outcome.status_code is None or outcome.status_code >= 500)
+
+
+class CircuitBreaker(object):
+    '''
+    Keeps a circuit breaker per target host. The breaker of a host opens after failure_threshold consecutive failed requests, and requests to
+    the host are skipped while it is open. After reset_timeout seconds the breaker is half open and a single probe request is allowed:
+    the breaker closes if it succeeds and opens again if it fails.
+    The state is kept in the process, or in the Django cache when shared is True, so all sending processes share it.
+    '''
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT, shared=False):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.shared = shared
+        self._states = {}
+
+    @classmethod
+    def from_settings(cls):
+        '''returns the circuit breaker configured in settings, or None when it is switched off'''
+        breaker_settings = get_breaker_settings()
+        if breaker_settings is None:
+            return None
+        return cls(failure_threshold=breaker_settings.get('failure_threshold', DEFAULT_FAILURE_THRESHOLD),
+                   reset_timeout=breaker_settings.get('reset_timeout', DEFAULT_RESET_TIMEOUT),
+                   shared=breaker_settings.get('backend', 'memory') == 'cache')
+
+    def get_state(self, host):
+        '''returns the state of the breaker of the given host: a dict of state, consecutive failures and the time it has been opened'''
+        state = cache.get(BREAKER_CACHE_KEY.format(host)) if self.shared else self._states.get(host)
+        return state or dict(state=CLOSED, failures=0, opened_at=None)
+
+    def get_states(self, hosts):
+        return {host: self.get_state(host) for host in hosts}
+
+    def _set_state(self, host, state):
+        if self.shared:
+            cache.set(BREAKER_CACHE_KEY.format(host), state, timeout=None)
+        else:
+            self._states[host] = state
+
+    def allow(self, host):
+        '''returns whether a request may be sent to the given host. Once the breaker has been open for reset_timeout, the caller sends the probe'''
+        state = self.get_state(host)
+        if state['state'] == CLOSED:
+            return True
+        if self.seconds_to_probe(host, state):
+            return False
+        # a probe which got no result within reset_timeout (e.g. its process was killed) is replaced by a new one
+        logger.info('Circuit breaker of {} is half open, sending a probe request'.format(host))
+        self._set_state(host, dict(state, state=HALF_OPEN, opened_at=time.time()))
+        return True
+
+    def seconds_to_probe(self, host, state=None):
+        '''returns the number of seconds until the next probe request to the given host is allowed'''
+        state = state or self.get_state(host)
+        if state['state'] == CLOSED:
+            return 0
+        return max(state['opened_at'] + self.reset_timeout - time.time(), 0)
+
+    def record(self, host, failed):
+        '''update the breaker of the given host with the result of a request sent to it'''
+        state = self.get_state(host)
+        if not failed:
+            if state['state'] != CLOSED or state['failures']:
+                if state['state'] != CLOSED:
+                    logger.info('Circuit breaker of {} is closed'.format(host))
+                self._set_state(host, dict(state=CLOSED, failures=0, opened_at=None))
+            return
+        failures = state['failures'] + 1
+        if state['state'] == HALF_OPEN or failures >= self.failure_threshold:
+            if state['state'] != OPEN:
+                logger.warning('Circuit breaker of {} is open after {} consecutive failures'.format(host, failures))
+            self._set_state(host, dict(state=OPEN, failures=failures, opened_at=time.time()))
+        else:
+            self._set_state(host, dict(state, failures=failures))
@@ -0,0 +1,450 @@
+import os
+import time
+import random
+import socket
+import uuid
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+from logging import getLogger
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from requests.exceptions import RequestException
+from infi.django_http_hooks.hooks.models import Callback
+from infi.django_http_hooks.http_requests import SessionPool, send_request, get_host, get_timeouts, DEFAULT_MAX_RESPONSE_BYTES, \
+                                                DEFAULT_MAX_DRAIN_BYTES
+from infi.django_http_hooks.circuit_breaker import CircuitBreaker, is_host_failure
+from infi.django_http_hooks.metrics import get_metrics
+
+logger = getLogger(__name__)
+
+# number of seconds a claimed callback stays in_progress before it returns to the queue
+DEFAULT_LEASE_SECONDS = 300
+# number of seconds the dispatcher waits for the rate limit of a host before returning its callbacks to the queue
+DEFAULT_MAX_THROTTLE_WAIT = 10
+# number of sent callbacks written back to the database in a single statement
+WRITE_BATCH_SIZE = 500
+# the columns updated with the result of sending a callback
+RESULT_FIELDS = ['status', 'status_details', 'attempts', 'next_attempt_at', 'lease_owner', 'lease_expires_at', 'update_datetime']
+
+
+# the result of sending a single callback. error is None when the request succeeded, body is the beginning of the response body of a failed request
+Outcome = namedtuple('Outcome', ['status_code', 'error', 'elapsed', 'body'])
+
+
+def get_worker_id():
+    '''a unique name of the current sending process, used as the owner of the callbacks it claims'''
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def release_expired_leases():
+    '''return callbacks whose lease has expired (e.g. their sending process was killed) to the queue'''
+    released = Callback.objects.filter(status='in_progress', lease_expires_at__lt=timezone.now()) \
+                               .update(status='waiting', lease_owner=None, lease_expires_at=None)
+    if released:
+        logger.warning('Released {} callbacks with expired lease'.format(released))
+    return released
+
+
+def claim_callbacks(owner, batch_size=None, lease_seconds=DEFAULT_LEASE_SECONDS, due_only=True, **filter_):
+    '''
+    Atomically move up to batch_size waiting callbacks to status in_progress, leased by the given owner for lease_seconds.
+    Rows locked by other claiming processes are skipped where the database supports SELECT ... FOR UPDATE SKIP LOCKED,
+    so multiple processes can claim callbacks at the same time without sending any of them twice.
+    :param due_only: Claim only callbacks whose next_attempt_at has passed. Set to False to claim retried callbacks before their time
+    :return: list of the claimed callbacks
+    '''
+    release_expired_leases()
+    now_ = timezone.now()
+    queryset = Callback.objects.filter(status='waiting', **filter_).order_by('id')
+    if due_only:
+        # callbacks inserted without next_attempt_at (e.g. by raw SQL) are due at once
+        queryset = queryset.filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now_))
+    if connection.features.has_select_for_update_skip_locked:
+        queryset = queryset.select_for_update(skip_locked=True)
+    with transaction.atomic():
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        # filtering by status again protects databases without row locks from claiming callbacks claimed meanwhile
+        Callback.objects.filter(id__in=ids, status='waiting').update(status='in_progress',
+                                                                     lease_owner=owner,
+                                                                     lease_expires_at=now_ + timedelta(seconds=lease_seconds),
+                                                                     update_datetime=now_)
+    return list(Callback.objects.filter(id__in=ids, status='in_progress', lease_owner=owner).select_related('hook').order_by('id'))
+
+
+def release_callbacks(callbacks, next_attempt_at):
+    '''return claimed callbacks to the queue without sending them, to be claimed again only from next_attempt_at'''
+    Callback.objects.filter(id__in=[c.id for c in callbacks], status='in_progress') \
+                    .update(status='waiting', lease_owner=None, lease_expires_at=None, next_attempt_at=next_attempt_at)
+
+
+def get_retry_delay(hook, attempts):
+    '''returns the number of seconds to wait before retrying a callback of the given hook which has failed attempts times'''
+    delay = hook.retry_backoff_base * hook.retry_backoff_factor ** (attempts - 1)
+    return delay * (1 + random.uniform(-hook.retry_backoff_jitter, hook.retry_backoff_jitter))
+
+
+def is_batched(hook):
+    return bool(hook.batch_max_events and hook.batch_max_events > 1)
+
+
+def group_callbacks(callbacks, now_):
+    '''
+    Split the callbacks into batches of callbacks to send together in one request.
+    Callbacks of hooks with batch_max_events are grouped into batches of up to batch_max_events callbacks and batch_max_bytes bytes,
+    any other callback is sent alone. A partial batch whose oldest callback is younger than batch_max_wait seconds is deferred,
+    waiting for more callbacks.
+    :return: list of batches (lists of callbacks) and a list of deferred callbacks with the time their batch should be sent
+    '''
+    batches, deferred = [], []
+    callbacks_by_hook = OrderedDict()
+    for callback in callbacks:
+        if is_batched(callback.hook):
+            callbacks_by_hook.setdefault(callback.hook_id, []).append(callback)
+        else:
+            batches.append([callback])
+
+    for hook_callbacks in callbacks_by_hook.values():
+        hook = hook_callbacks[0].hook
+        batch, batch_size = [], 0
+        for callback in hook_callbacks:
+            # the payload and its separator
+            size = len((callback.payload or '').encode('utf-8')) + 1
+            if batch and (len(batch) >= hook.batch_max_events or (hook.batch_max_bytes and batch_size + size > hook.batch_max_bytes)):
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(callback)
+            batch_size += size
+        # the last batch is the only one which may be partial
+        if len(batch) < hook.batch_max_events and hook.batch_max_wait and \
+                batch[0].create_datetime > now_ - timedelta(seconds=hook.batch_max_wait):
+            deferred.append((batch, batch[0].create_datetime + timedelta(seconds=hook.batch_max_wait)))
+        else:
+            batches.append(batch)
+    return batches, deferred
+
+
+def build_request(batch):
+    '''returns the arguments of send_request for sending the given batch of callbacks. Callbacks of a batched hook are sent as an array'''
+    first = batch[0]
+    request = dict(url=first.target_url, method=first.http_method, headers=first.headers, content_type=first.content_type, payload=first.payload,
+                   timeouts=get_timeouts(first.hook))
+    if is_batched(first.hook):
+        payloads = [callback.payload or '' for callback in batch]
+        if first.hook.batch_format == 'ndjson':
+            request['payload'] = ''.join(payload + '\n' for payload in payloads)
+            request['content_type'] = 'application/x-ndjson'
+        else:
+            request['payload'] = '[' + ','.join(payloads) + ']'
+    return request
+
+
+def get_host_limits(host):
+    '''
+    returns the limits of the given target host from the DJANGO_HTTP_HOOKS_HOST_LIMITS setting.
+    Limits are looked up by the scheme and network location of the host (e.g. https://example.com:8443), then by its network location only,
+    then by '*' which holds the limits of any other host
+    '''
+    limits = getattr(settings, 'DJANGO_HTTP_HOOKS_HOST_LIMITS', {})
+    for key in (host, host.split('://', 1)[-1], '*'):
+        if key in limits:
+            return limits[key]
+    return {}
+
+
+class HostLimiter(object):
+    '''
+    Limits the requests sent to a single target host: a token bucket allows up to rate requests per second, with bursts of up to burst requests,
+    and up to max_in_flight requests are sent at the same time. Missing limits are not enforced.
+    The limiter is used by the calling thread of the dispatcher only.
+    '''
+
+    def __init__(self, rate=None, burst=None, max_in_flight=None):
+        self.rate = rate
+        self.burst = burst or max(rate or 1, 1)
+        self.max_in_flight = max_in_flight
+        self.tokens = self.burst
+        self.in_flight = 0
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now_ = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now_ - self.updated_at) * self.rate)
+        self.updated_at = now_
+
+    def wait_time(self):
+        '''
+        returns 0 if a request can be sent now, None if it waits for a request in flight to finish,
+        or the number of seconds until the rate limit allows the next request
+        '''
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return None
+        if not self.rate:
+            return 0
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        if self.rate:
+            self.tokens -= 1
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+
+class HostStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.callbacks = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def add(self, outcome, callbacks=1):
+        self.requests += 1
+        self.callbacks += callbacks
+        if outcome.error is not None:
+            self.errors += 1
+        self.total_latency += outcome.elapsed
+        self.max_latency = max(self.max_latency, outcome.elapsed)
+
+    @property
+    def avg_latency(self):
+        return self.total_latency / self.requests if self.requests else 0.0
+
+
+class DispatchStats(object):
+    '''collects the throughput of a dispatcher run and the latency of the requests per target host'''
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.hosts = OrderedDict()
+        # callbacks which were not sent in this run and returned to the queue, waiting for their batch, for the rate limit of their host
+        # or for the circuit breaker of their host to close
+        self.deferred = 0
+        self.throttled = 0
+        self.skipped = 0
+
+    def add(self, host, outcome, callbacks=1):
+        self.hosts.setdefault(host, HostStats()).add(outcome, callbacks)
+
+    def finish(self):
+        self.end_time = time.time()
+
+    @property
+    def requests(self):
+        return sum(h.requests for h in self.hosts.values())
+
+    @property
+    def callbacks(self):
+        return sum(h.callbacks for h in self.hosts.values())
+
+    @property
+    def errors(self):
+        return sum(h.errors for h in self.hosts.values())
+
+    @property
+    def duration(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def throughput(self):
+        return self.requests / self.duration if self.duration else 0.0
+
+    def report(self):
+        lines = ['Sent {} requests ({} callbacks) in {:.2f} seconds ({:.1f} requests/second). {} requests failed. '
+                 '{} callbacks deferred, {} callbacks throttled, {} callbacks skipped.'.format(
+            self.requests, self.callbacks, self.duration, self.throughput, self.errors, self.deferred, self.throttled, self.skipped)]
+        for host, stats in self.hosts.items():
+            lines.append('{}: {} requests, {} failed, avg latency {:.3f}s, max latency {:.3f}s'.format(
+                host, stats.requests, stats.errors, stats.avg_latency, stats.max_latency))
+        return lines
+
+
+ENGINES = ('threads', 'asyncio')
+
+
+def create_dispatcher(engine='threads', **kwargs):
+    '''returns a dispatcher sending requests by a pool of threads, or by asyncio (requires the httpx package)'''
+    if engine == 'asyncio':
+        from infi.django_http_hooks.async_dispatcher import AsyncDispatcher
+        return AsyncDispatcher(**kwargs)
+    return Dispatcher(**kwargs)
+
+
+class Dispatcher(object):
+    '''
+    Sends the HTTP requests of the given callbacks and updates each callback with the response details.
+    With concurrency > 1 the requests are sent by a pool of threads, while the callbacks are updated in the calling thread only.
+    Requests are sent within the limits of their target host (see get_host_limits). Callbacks which would wait for the rate limit of their host
+    longer than max_throttle_wait seconds return to the queue until the rate limit allows them.
+    Callbacks of hosts whose circuit breaker is open return to the queue until the breaker allows a probe request.
+    '''
+
+    def __init__(self, concurrency=1, pool_size=None, max_throttle_wait=DEFAULT_MAX_THROTTLE_WAIT):
+        self.concurrency = max(concurrency or 1, 1)
+        self.pool = SessionPool(pool_size or self.concurrency)
+        self.max_throttle_wait = max_throttle_wait
+        # the limiters are kept between runs, so a resident worker keeps to the rate limits
+        self.limiters = {}
+        self.breaker = CircuitBreaker.from_settings()
+        # only the beginning of the response body is read, for the status details of failed callbacks
+        self.max_response_bytes = getattr(settings, 'DJANGO_HTTP_HOOKS_MAX_RESPONSE_BYTES', DEFAULT_MAX_RESPONSE_BYTES)
+        # the rest of the body is read and dropped up to max_drain_bytes, so the connection returns to the pool
+        self.max_drain_bytes = getattr(settings, 'DJANGO_HTTP_HOOKS_MAX_DRAIN_BYTES', DEFAULT_MAX_DRAIN_BYTES)
+        # sent callbacks which were not written back to the database yet
+        self._results = []
+
+    def get_limiter(self, host):
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = self.limiters[host] = HostLimiter(**get_host_limits(host))
+        return limiter
+
+    def send(self, callbacks):
+        stats = DispatchStats()
+        run_time = timezone.now()
+        batches, deferred = group_callbacks(callbacks, run_time)
+        for batch, next_attempt_at in deferred:
+            release_callbacks(batch, next_attempt_at)
+            stats.deferred += len(batch)
+
+        # requests are built by the calling thread, so the worker threads do not touch the database
+        pending = OrderedDict()
+        for batch in batches:
+            request = build_request(batch)
+            pending.setdefault(get_host(request['url']), deque()).append((batch, request))
+        try:
+            self._send_pending(pending, run_time, stats)
+        finally:
+            self._flush_results()
+        stats.finish()
+        return stats
+
+    def _send_pending(self, pending, run_time, stats):
+        if self.concurrency == 1:
+            self._schedule(pending, None, run_time, stats)
+        else:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                self._schedule(pending, lambda request: executor.submit(self._deliver, request), run_time, stats)
+
+    def _schedule(self, pending, submit, run_time, stats):
+        '''
+        send the pending requests of each host as soon as its limiter allows them. submit starts sending a request and returns its future.
+        Without submit, the requests are sent one by one by the calling thread.
+        Requests are submitted only while there are free workers, so they are sent at once: the rate limit and the circuit breaker of their
+        host are checked when they are actually sent, after the results of the previous requests
+        '''
+        deadline = time.monotonic() + self.max_throttle_wait
+        in_flight = {}
+        while pending or in_flight:
+            # the shortest time until the rate limit of any host allows its next request
+            next_token = None
+            for host in list(pending):
+                limiter, queue = self.get_limiter(host), pending[host]
+                while queue:
+                    if submit is not None and len(in_flight) >= self.concurrency:
+                        break
+                    wait_time = limiter.wait_time()
+                    if wait_time is None:
+                        break
+                    if wait_time:
+                        if time.monotonic() + wait_time > deadline:
+                            stats.throttled += self._release(queue, wait_time)
+                            queue.clear()
+                        else:
+                            next_token = wait_time if next_token is None else min(next_token, wait_time)
+                        break
+                    if self.breaker and not self.breaker.allow(host):
+                        # the requests in flight decide the state of the breaker, e.g. the probe of a half open breaker
+                        if not limiter.in_flight:
+                            stats.skipped += self._release(queue, self.breaker.seconds_to_probe(host))
+                            queue.clear()
+                        break
+                    batch, request = queue.popleft()
+                    limiter.acquire()
+                    if submit is None:
+                        outcome = self._deliver(request)
+                        limiter.release()
+                        self._record(batch, outcome, run_time, stats)
+                    else:
+                        in_flight[submit(request)] = (host, batch)
+                if not queue:
+                    del pending[host]
+            if in_flight:
+                done, _ = wait(in_flight, timeout=next_token, return_when=FIRST_COMPLETED)
+                for future in done:
+                    host, batch = in_flight.pop(future)
+                    self.get_limiter(host).release()
+                    self._record(batch, future.result(), run_time, stats)
+            elif next_token:
+                time.sleep(next_token)
+
+    def _release(self, queue, wait_time):
+        '''return the callbacks of the queued requests to the queue for wait_time seconds. returns the number of released callbacks'''
+        next_attempt_at = timezone.now() + timedelta(seconds=wait_time)
+        for batch, request in queue:
+            release_callbacks(batch, next_attempt_at)
+        return sum(len(batch) for batch, request in queue)
+
+    def close(self):
+        self.pool.close()
+
+    def _deliver(self, request):
+        '''sends the given request. Being called by the worker threads so must not touch the database'''
+        start = time.time()
+        try:
+            res = send_request(pool=self.pool, max_response_bytes=self.max_response_bytes, max_drain_bytes=self.max_drain_bytes, **request)
+            return Outcome(res.status_code, None, time.time() - start, None)
+        except RequestException as e:
+            # timeouts are failures like any other error, so they are retried as well
+            if e.response is not None:
+                return Outcome(e.response.status_code, e, time.time() - start, e.response.content.decode('utf-8', errors='replace'))
+            return Outcome(None, e, time.time() - start, None)
+
+    def _record(self, batch, outcome, run_time, stats):
+        '''update all callbacks of the batch with the response of their request'''
+        for callback in batch:
+            callback.attempts += 1
+            if outcome.error is None:
+                callback.status = 'sent'
+                callback.status_details = u'status_code:{status_code}'.format(status_code=outcome.status_code)
+            else:
+                callback.status_details = u'status_code:{status_code}-{error_msg}'.format(status_code=outcome.status_code or '#N/A',
+                                                                                          error_msg=outcome.error)
+                if outcome.body:
+                    callback.status_details += u'-{}'.format(outcome.body)
+                callback.status_details = callback.status_details[:512]
+                if callback.attempts <= callback.hook.retry_max_attempts:
+                    # return to the queue until the retry time
+                    callback.status = 'waiting'
+                    callback.next_attempt_at = run_time + timedelta(seconds=get_retry_delay(callback.hook, callback.attempts))
+                else:
+                    callback.status = 'error'
+            callback.lease_owner = None
+            callback.lease_expires_at = None
+            callback.update_datetime = run_time
+        self._results.extend(batch)
+        if len(self._results) >= WRITE_BATCH_SIZE:
+            self._flush_results()
+        host = get_host(batch[0].target_url)
+        if self.breaker:
+            self.breaker.record(host, is_host_failure(outcome))
+        stats.add(host, outcome, len(batch))
+        # requests which got no response are labeled by status 'none'
+        status = outcome.status_code or 'none'
+        metrics = get_metrics()
+        metrics.inc('django_http_hooks_deliveries_total', host=host, status=status)
+        metrics.observe('django_http_hooks_delivery_seconds', outcome.elapsed, host=host, status=status)
+
+    def _flush_results(self):
+        '''write the results of the sent callbacks back to the database, updating only their result columns'''
+        if self._results:
+            Callback.objects.bulk_update(self._results, RESULT_FIELDS, batch_size=WRITE_BATCH_SIZE)
+            self._results = []
@@ -18,11 +18,19 @@ class HookAdmin(admin.ModelAdmin):
         ('Hook HTTP Request Details', {
             'fields': ('target_url', 'http_method', 'headers', 'content_type', 'payload_template', 'serializer_class')
         }),
+        ('Hook Payload Validation', {
+            'fields': ('payload_validation', 'payload_validation_sample_rate')
+        }),
+        ('Hook Delivery Details', {
+            'fields': ('retry_max_attempts', 'retry_backoff_base', 'retry_backoff_factor', 'retry_backoff_jitter',
+                       'batch_max_events', 'batch_max_bytes', 'batch_max_wait', 'batch_format', 'coalesce_window',
+                       'connect_timeout', 'read_timeout', 'total_timeout')
+        }),
     )
 
 
 class CallbackAdmin(admin.ModelAdmin):
-    list_display = ('hook', 'status', 'status_details', 'create_datetime')
+    list_display = ('hook', 'status', 'status_details', 'attempts', 'next_attempt_at', 'create_datetime')
     search_fields = ('hook', 'target_url', 'status_details')
     list_filter = [('hook', RelatedDropdownFilter), 'status']
 
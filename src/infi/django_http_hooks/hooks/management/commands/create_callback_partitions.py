@@ -0,0 +1,28 @@
+from logging import getLogger
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from infi.django_http_hooks.partitions import INTERVALS, DEFAULT_PERIODS_AHEAD, create_partitions, convert_to_partitioned, \
+                                             get_partition_interval, is_partitioned
+
+logger = getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Create the partitions of the callbacks table for the coming days or months (PostgreSQL only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', choices=INTERVALS, help='Length of each partition. Default: DJANGO_HTTP_HOOKS_CALLBACK_PARTITIONS, or day')
+        parser.add_argument('--ahead', type=int, default=DEFAULT_PERIODS_AHEAD, help='Number of partitions to create after the current one')
+        parser.add_argument('--convert', action='store_true', help='Convert the callbacks table to a partitioned table first, if it is not one yet')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partitioning callbacks is supported on PostgreSQL only')
+        interval = options['interval'] or get_partition_interval()
+        if not is_partitioned():
+            if not options['convert']:
+                raise CommandError('The callbacks table is not partitioned. Use --convert to convert it to a partitioned table')
+            convert_to_partitioned(interval)
+        created = create_partitions(interval, options['ahead'])
+        logger.info('Created {} partitions of callbacks'.format(len(created)))
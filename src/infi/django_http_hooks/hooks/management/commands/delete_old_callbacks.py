@@ -1,9 +1,11 @@
+import time
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from django.db import connection
 from logging import getLogger
 from datetime import timedelta
-from infi.django_http_hooks.hooks.models import Callback
+from infi.django_http_hooks.hooks.models import Callback, CALLBACK_STATUSES
+from infi.django_http_hooks.partitions import is_partitioned, drop_partitions
 
 
 logger = getLogger(__name__)
@@ -15,19 +17,49 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('days_back', type=int)
+        parser.add_argument('--batch_size', type=int, default=10000, help='Number of consecutive callback ids to delete in each statement')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to sleep between the deleted batches, to throttle the load on the database')
+        parser.add_argument('--status', nargs='+', choices=CALLBACK_STATUSES, help='Delete only callbacks with the given statuses, e.g. keep failed callbacks longer')
 
     def handle(self, *args, **options):
         now_ = timezone.now()
         date_to_delete_from = now_ - timedelta(days=options['days_back'])
         table_name = Callback._meta.db_table
+        # partitions holding only old callbacks are dropped at once. Partitions hold callbacks of any status, so they are kept when filtering
+        if not options['status'] and is_partitioned():
+            dropped = drop_partitions(date_to_delete_from)
+            logger.info('Dropped {} partitions of old callbacks'.format(len(dropped)))
+
+        # the rest of the old callbacks, e.g. of a partition holding new callbacks as well, are deleted in batches
         callbacks_to_delete = Callback.objects.filter(create_datetime__lt=date_to_delete_from)
-        if callbacks_to_delete:
-            logger.info('About to delete {} callbacks before {}'.format(callbacks_to_delete.count(), date_to_delete_from))
-            callbacks_to_delete.delete()
+        if options['status']:
+            callbacks_to_delete = callbacks_to_delete.filter(status__in=options['status'])
+
+        # callbacks are created in the order of their ids, so the old callbacks are the ones before the last old callback
+        first_id = Callback.objects.order_by('id').values_list('id', flat=True).first()
+        last_id = callbacks_to_delete.order_by('-id').values_list('id', flat=True).first()
+        if last_id is None:
+            logger.info('No callbacks were deleted')
+            return
 
-            cursor = connection.cursor()
-            cursor.execute('VACUUM ANALYZE {}'.format(table_name))
+        logger.info('About to delete callbacks before {} with ids up to {}'.format(date_to_delete_from, last_id))
+        where = 'id >= %s AND id < %s AND create_datetime < %s'
+        if options['status']:
+            where += ' AND status IN ({})'.format(', '.join(['%s'] * len(options['status'])))
+        sql = 'DELETE FROM {} WHERE {}'.format(connection.ops.quote_name(table_name), where)
+        deleted = 0
+        for start in range(first_id, last_id + 1, options['batch_size']):
+            # each batch is deleted by a statement of its own, so locks are held for a short time only
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [start, start + options['batch_size'], date_to_delete_from] + (options['status'] or []))
+                deleted += cursor.rowcount
+            logger.debug('Deleted {} callbacks up to id {}'.format(deleted, start + options['batch_size'] - 1))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        logger.info('Deleted {} callbacks'.format(deleted))
 
+        # reclaim the space of the deleted rows and update the statistics of the table, where the database supports it
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM ANALYZE {}'.format(connection.ops.quote_name(table_name)))
             logger.info('Executed VACUUM ANALYZE on table {}'.format(table_name))
-        else:
-            logger.info('No callbacks were deleted')
\ No newline at end of file
@@ -1,11 +1,75 @@
 from logging import getLogger
+from django.conf import settings
 from django.utils import timezone
 from django.core.management.base import BaseCommand
 from infi.django_http_hooks.hooks.models import Callback
+from infi.django_http_hooks.api import get_callback_stats
+from infi.django_http_hooks.circuit_breaker import CircuitBreaker, CLOSED
+from infi.django_http_hooks.http_requests import get_host
 from datetime import timedelta
+import json
 import sys
 logger = getLogger(__name__)
 
+FORMATS = ('text', 'json', 'prometheus')
+THRESHOLDS = ('max_waiting', 'max_waiting_age', 'max_error_rate')
+
+
+def get_hook_thresholds(hook_stats):
+    '''returns the thresholds of the given hook from the DJANGO_HTTP_HOOKS_MONITOR_THRESHOLDS setting, by its name, its id or '*' for any hook'''
+    thresholds = getattr(settings, 'DJANGO_HTTP_HOOKS_MONITOR_THRESHOLDS', {})
+    for key in (hook_stats['hook'], str(hook_stats['hook_id']), '*'):
+        if key in thresholds:
+            return thresholds[key]
+    return {}
+
+
+def check_thresholds(name, stats, thresholds):
+    '''returns the violations of the given thresholds by the given statistics (of a hook or of all hooks)'''
+    violations = []
+    waiting = stats['counts'].get('waiting', 0)
+    if thresholds.get('max_waiting') is not None and waiting > thresholds['max_waiting']:
+        violations.append('{}: {} waiting callbacks, more than {}'.format(name, waiting, thresholds['max_waiting']))
+    age = stats['oldest_waiting_age']
+    if thresholds.get('max_waiting_age') is not None and age is not None and age > thresholds['max_waiting_age']:
+        violations.append('{}: the oldest waiting callback waits {:.0f} seconds, more than {}'.format(name, age, thresholds['max_waiting_age']))
+    error_rate = stats['error_rate']
+    if thresholds.get('max_error_rate') is not None and error_rate is not None and error_rate > thresholds['max_error_rate']:
+        violations.append('{}: error rate {:.1%}, more than {:.1%}'.format(name, error_rate, thresholds['max_error_rate']))
+    return violations
+
+
+def get_totals(hooks_stats):
+    '''returns the statistics of all hooks together'''
+    counts = {}
+    for hook_stats in hooks_stats:
+        for status, count in hook_stats['counts'].items():
+            counts[status] = counts.get(status, 0) + count
+    ages = [hook_stats['oldest_waiting_age'] for hook_stats in hooks_stats if hook_stats['oldest_waiting_age'] is not None]
+    done = counts.get('sent', 0) + counts.get('error', 0)
+    return dict(counts=counts, oldest_waiting_age=max(ages) if ages else None, error_rate=counts.get('error', 0) / done if done else None)
+
+
+def format_prometheus(hooks_stats):
+    '''returns the statistics of the hooks in the Prometheus text exposition format'''
+    def labels(hook_stats, **extra):
+        values = [('hook', hook_stats['hook']), ('hook_id', hook_stats['hook_id'])] + sorted(extra.items())
+        return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in values)
+
+    lines = ['# HELP django_http_hooks_callbacks Number of callbacks by hook and status',
+             '# TYPE django_http_hooks_callbacks gauge']
+    for hook_stats in hooks_stats:
+        for status, count in sorted(hook_stats['counts'].items()):
+            lines.append('django_http_hooks_callbacks{{{}}} {}'.format(labels(hook_stats, status=status), count))
+    for metric, key, help_ in (('django_http_hooks_oldest_waiting_seconds', 'oldest_waiting_age', 'Age of the oldest waiting callback of the hook'),
+                               ('django_http_hooks_error_rate', 'error_rate', 'Failed callbacks out of the sent and failed callbacks of the hook')):
+        lines += ['# HELP {} {}'.format(metric, help_), '# TYPE {} gauge'.format(metric)]
+        for hook_stats in hooks_stats:
+            if hook_stats[key] is not None:
+                lines.append('{}{{{}}} {}'.format(metric, labels(hook_stats), hook_stats[key]))
+    return '\n'.join(lines) + '\n'
+
+
 class Command(BaseCommand):
 
     help = 'Monitor callbacks according to given time range and limits'
@@ -13,22 +77,52 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--minutes_ago', type=int, help='check if there are more than the given amount of waiting callbacks')
         parser.add_argument('--callbacks_limit', type=int, help='limit for callbacks in the last minutes ago', default=10)
-        parser.add_argument('--status', type=str, help='Callback type to check: waiting/error', required=True)
+        parser.add_argument('--status', type=str, help='Callback type to check against callbacks_limit: waiting/error')
+        parser.add_argument('--max_waiting', type=int, help='Maximal number of waiting callbacks of all hooks')
+        parser.add_argument('--max_waiting_age', type=float, help='Maximal age in seconds of the oldest waiting callback')
+        parser.add_argument('--max_error_rate', type=float, help='Maximal fraction of failed callbacks out of the sent and failed callbacks of all hooks, e.g. 0.05')
+        parser.add_argument('--format', choices=FORMATS, default='text', help='Output format of the statistics of the hooks')
 
+    def report_breakers(self):
+        '''log the circuit breakers which are not closed, of the hosts of the callbacks in the queue. Requires a breaker shared by the cache'''
+        breaker = CircuitBreaker.from_settings()
+        if not (breaker and breaker.shared):
+            return
+        target_urls = Callback.objects.filter(status__in=('waiting', 'in_progress')).values_list('target_url', flat=True).distinct()
+        states = breaker.get_states(set(get_host(url) for url in target_urls))
+        for host, state in sorted(states.items()):
+            if state['state'] != CLOSED:
+                logger.warning('Circuit breaker of {} is {} after {} consecutive failures'.format(host, state['state'], state['failures']))
 
     def handle(self, *args, **options):
-        filter_ = dict(status=options['status'])
+        self.report_breakers()
         since_when = None
         if options.get('minutes_ago'):
             now_ = timezone.now()
             since_when = now_ - timedelta(minutes=options['minutes_ago'])
+            logger.info('Checks callbacks since {}'.format(since_when.strftime('%Y-%m-%d %H:%M:%S')))
 
-            filter_["update_datetime__gt"] = since_when
+        hooks_stats = get_callback_stats(since_when)
+        totals = get_totals(hooks_stats)
 
-            logger.info('Checks for {} callbacks since {}'.format(options['status'], since_when.strftime('%Y-%m-%d %H:%M:%S')))
+        violations = []
+        if options['status']:
+            callbacks_amt = totals['counts'].get(options['status'], 0)
+            if callbacks_amt >= options['callbacks_limit']:
+                violations.append('There are {} {} callbacks in the queue since {}'.format(
+                    callbacks_amt, options['status'], since_when.strftime('%Y-%m-%d %H:%M:%S') if since_when else 'beginning of time.'))
+        violations += check_thresholds('All hooks', totals, {key: options[key] for key in THRESHOLDS})
+        for hook_stats in hooks_stats:
+            violations += check_thresholds('Hook {}'.format(hook_stats['hook']), hook_stats, get_hook_thresholds(hook_stats))
 
-        callbacks = Callback.objects.filter(**filter_)
-        callbacks_amt = len(callbacks)
-        if callbacks_amt >= options['callbacks_limit']:
-            logger.warn('There are {} {} callbacks in the queue since {}'.format(callbacks_amt, options['status'], since_when.strftime('%Y-%m-%d %H:%M:%S') if since_when else 'beginning of time.'))
+        if options['format'] == 'json':
+            self.stdout.write(json.dumps(dict(hooks=hooks_stats, totals=totals, violations=violations)))
+        elif options['format'] == 'prometheus':
+            self.stdout.write(format_prometheus(hooks_stats), ending='')
+        else:
+            for hook_stats in hooks_stats:
+                logger.info('Hook {hook}: {counts}, oldest waiting callback age: {oldest_waiting_age}, error rate: {error_rate}'.format(**hook_stats))
+        for violation in violations:
+            logger.warning(violation)
+        if violations:
             sys.exit(1)
@@ -0,0 +1,106 @@
+import signal
+import threading
+import time
+from logging import getLogger
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from infi.django_http_hooks.dispatcher import create_dispatcher, claim_callbacks, get_worker_id, DEFAULT_LEASE_SECONDS, DEFAULT_MAX_THROTTLE_WAIT, ENGINES
+from infi.django_http_hooks.metrics import update_queue_depth, write_metrics
+
+logger = getLogger(__name__)
+
+class Command(BaseCommand):
+
+    help = 'Keep running and send HTTP requests for waiting callbacks as soon as they are created'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hook_id', type=str, help='Send only requests related to given hook')
+        parser.add_argument('--batch_size', type=int, default=100, help='Maximum number of callbacks to fetch and send at once')
+        parser.add_argument('--lease_seconds', type=int, default=DEFAULT_LEASE_SECONDS, help='Seconds before callbacks claimed by a dead process return to the queue')
+        parser.add_argument('--engine', choices=ENGINES, default='threads', help='Send the requests by a pool of threads, or by asyncio (requires httpx)')
+        parser.add_argument('--concurrency', type=int, help='Number of requests to send in parallel. Default: 1 for threads, 100 for asyncio')
+        parser.add_argument('--http2', action='store_true', help='Use HTTP/2 when the target host supports it. Requires the asyncio engine and the h2 package')
+        parser.add_argument('--pool_size', type=int, help='Maximum number of keep-alive connections per target host. Default: the concurrency')
+        parser.add_argument('--max_throttle_wait', type=float, default=DEFAULT_MAX_THROTTLE_WAIT,
+                            help='Seconds to wait for the rate limit of a target host before returning its callbacks to the queue')
+        parser.add_argument('--idle_sleep', type=float, default=0.5, help='Seconds to wait before polling again when there are no waiting callbacks')
+        parser.add_argument('--max_idle_sleep', type=float, default=5.0, help='The idle sleep is doubled while idle, up to this number of seconds')
+        parser.add_argument('--exit_when_idle', action='store_true', help='Exit once there are no waiting callbacks, instead of waiting for new ones')
+        parser.add_argument('--metrics_file', type=str, help='Write the metrics of the worker to this file (see DJANGO_HTTP_HOOKS_METRICS)')
+        parser.add_argument('--metrics_interval', type=float, default=15.0, help='Seconds between writes of the metrics file')
+
+    def create_dispatcher(self, options):
+        kwargs = dict(concurrency=options['concurrency'], pool_size=options['pool_size'], max_throttle_wait=options['max_throttle_wait'])
+        if options['http2']:
+            if options['engine'] != 'asyncio':
+                raise CommandError('--http2 requires --engine asyncio')
+            kwargs['http2'] = True
+        return create_dispatcher(options['engine'], **kwargs)
+
+    def handle(self, *args, **options):
+        self.stopped = threading.Event()
+        previous_handlers = {signum: signal.signal(signum, self.stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+        filter_ = {}
+        if options['hook_id']:
+            filter_['hook_id'] = options['hook_id']
+
+        owner = get_worker_id()
+        dispatcher = self.create_dispatcher(options)
+        idle_sleep = options['idle_sleep']
+        self.metrics_written_at = None
+        logger.info('Callback worker {} started'.format(owner))
+        try:
+            while not self.stopped.is_set():
+                # the worker runs for a long time, so drop database connections which were closed or expired meanwhile
+                close_old_connections()
+                try:
+                    stats = self.send_batch(dispatcher, owner, filter_, options)
+                    self.write_metrics(options)
+                except Exception:
+                    # e.g. the database failed over. Only a stop request stops the worker, and callbacks claimed by the failed batch
+                    # return to the queue once their lease expires
+                    logger.exception('Failed sending callbacks, retrying in {} seconds'.format(idle_sleep))
+                    close_old_connections()
+                    self.stopped.wait(idle_sleep)
+                    idle_sleep = min(idle_sleep * 2, options['max_idle_sleep'])
+                    continue
+                if stats and stats.requests:
+                    idle_sleep = options['idle_sleep']
+                elif options['exit_when_idle']:
+                    break
+                else:
+                    self.stopped.wait(idle_sleep)
+                    idle_sleep = min(idle_sleep * 2, options['max_idle_sleep'])
+        finally:
+            dispatcher.close()
+            close_old_connections()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        logger.info('Callback worker stopped')
+
+    def send_batch(self, dispatcher, owner, filter_, options):
+        '''claim and send a single batch of callbacks. Returns the statistics of the batch, or None if there were no waiting callbacks'''
+        callbacks_to_send = claim_callbacks(owner, options['batch_size'], options['lease_seconds'], **filter_)
+        stats = None
+        if callbacks_to_send:
+            # a stop request during sending takes effect only after all requests of the batch are done
+            stats = dispatcher.send(callbacks_to_send)
+            for line in stats.report():
+                logger.info(line)
+        return stats
+
+    def write_metrics(self, options):
+        '''write the metrics file once per metrics_interval seconds, since counting the queue depth queries the callbacks table'''
+        if not options['metrics_file']:
+            return
+        now = time.monotonic()
+        if self.metrics_written_at is not None and now - self.metrics_written_at < options['metrics_interval']:
+            return
+        update_queue_depth()
+        write_metrics(options['metrics_file'])
+        self.metrics_written_at = now
+
+    def stop(self, signum, frame):
+        logger.info('Got signal {}, stopping after sending the current batch'.format(signum))
+        self.stopped.set()
@@ -1,9 +1,6 @@
 from logging import getLogger
-from django.utils import timezone
-from django.core.management.base import BaseCommand
-from infi.django_http_hooks.hooks.models import Callback
-from infi.django_http_hooks.http_requests import send_request
-from requests.exceptions import HTTPError, ConnectionError
+from django.core.management.base import BaseCommand, CommandError
+from infi.django_http_hooks.dispatcher import create_dispatcher, claim_callbacks, get_worker_id, DEFAULT_LEASE_SECONDS, DEFAULT_MAX_THROTTLE_WAIT, ENGINES
 
 logger = getLogger(__name__)
 
@@ -14,30 +11,49 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--hook_id', type=str, help='Send only requests related to given hook')
         parser.add_argument('--callbacks', nargs='*', type=str, help='List of callbacks to send')
+        parser.add_argument('--engine', choices=ENGINES, default='threads', help='Send the requests by a pool of threads, or by asyncio (requires httpx)')
+        parser.add_argument('--concurrency', type=int, help='Number of requests to send in parallel. Default: 1 for threads, 100 for asyncio')
+        parser.add_argument('--http2', action='store_true', help='Use HTTP/2 when the target host supports it. Requires the asyncio engine and the h2 package')
+        parser.add_argument('--pool_size', type=int, help='Maximum number of keep-alive connections per target host. Default: the concurrency')
+        parser.add_argument('--max_throttle_wait', type=float, default=DEFAULT_MAX_THROTTLE_WAIT,
+                            help='Seconds to wait for the rate limit of a target host before returning its callbacks to the queue')
+        parser.add_argument('--batch_size', type=int, default=500, help='Number of callbacks to claim and send at once')
+        parser.add_argument('--lease_seconds', type=int, default=DEFAULT_LEASE_SECONDS, help='Seconds before callbacks claimed by a dead process return to the queue')
+
+    def create_dispatcher(self, options):
+        kwargs = dict(concurrency=options['concurrency'], pool_size=options['pool_size'], max_throttle_wait=options['max_throttle_wait'])
+        if options['http2']:
+            if options['engine'] != 'asyncio':
+                raise CommandError('--http2 requires --engine asyncio')
+            kwargs['http2'] = True
+        return create_dispatcher(options['engine'], **kwargs)
 
     def handle(self, *args, **options):
-        filter_ = {'status': 'waiting'}
+        filter_ = {}
         if options['hook_id']:
             filter_['hook_id'] = options['hook_id']
         elif options['callbacks']:
             filter_['id__in'] = options['callbacks']
-
-        callbacks_to_send = Callback.objects.filter(**filter_)
-
-        run_time = timezone.now()
-        errors = 0
-        if callbacks_to_send:
-            for idx, callback in enumerate(callbacks_to_send):
-                res = None
-                try:
-                    res = send_request(url=callback.target_url, method=callback.http_method, **callback.__dict__)
-                    callback.status = 'sent'
-                    callback.status_details = u'status_code:{status_code}'.format(status_code=res.status_code)
-                except (HTTPError, ConnectionError) as e:
-                    callback.status_details = u'status_code:{status_code}-{error_msg}'.format(status_code=res.status_code if res else '#N/A', error_msg=e)
-                    callback.status = 'error'
-                    errors += 1
-                callback.update_datetime = run_time
-                callback.save()
-
-            logger.info('Sent {} requests. {} requests failed.'.format(idx + 1, errors))
+            # the given callbacks are sent now, even if their retry time did not come yet
+            filter_['due_only'] = False
+
+        owner = get_worker_id()
+        dispatcher = self.create_dispatcher(options)
+        try:
+            # claim and send batch after batch, until no waiting callback is left
+            while True:
+                callbacks_to_send = claim_callbacks(owner, options['batch_size'], options['lease_seconds'], **filter_)
+                if not callbacks_to_send:
+                    break
+                stats = dispatcher.send(callbacks_to_send)
+                for line in stats.report():
+                    logger.info(line)
+                # the claimed callbacks were all deferred, claiming again would return them again
+                if not stats.requests:
+                    break
+                if options['callbacks']:
+                    # each given callback is attempted once, even if it failed and waits for a retry
+                    sent_ids = set(str(c.id) for c in callbacks_to_send)
+                    filter_['id__in'] = [id_ for id_ in filter_['id__in'] if id_ not in sent_ids]
+        finally:
+            dispatcher.close()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 09:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hooks', '0002_create_signals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callback',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='callback',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=256, null=True),
+        ),
+        migrations.AlterField(
+            model_name='callback',
+            name='status',
+            field=models.CharField(blank=True, choices=[('waiting', 'waiting'), ('in_progress', 'in_progress'), ('sent', 'sent'), ('error', 'error')], default='waiting', max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='callback',
+            index=models.Index(fields=['status', 'lease_expires_at'], name='hooks_callb_status_75246d_idx'),
+        ),
+    ]
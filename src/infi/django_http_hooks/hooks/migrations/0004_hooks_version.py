@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 09:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hooks', '0003_callback_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HooksVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+                ('update_datetime', models.DateTimeField(auto_now=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 10:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hooks', '0004_hooks_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hook',
+            name='payload_validation',
+            field=models.CharField(choices=[('always', 'Validate every payload'), ('sample', 'Validate a sample of the payloads'), ('on_save', 'Validate the payload template only when saving the hook')], default='always', help_text='When to validate payloads against the content type. Default and serializer JSON payloads are never validated.', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='payload_validation_sample_rate',
+            field=models.PositiveSmallIntegerField(default=10, help_text='Percent of the payloads to validate when validating a sample'),
+        ),
+    ]
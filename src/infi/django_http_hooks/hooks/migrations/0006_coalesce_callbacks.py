@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 10:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hooks', '0005_hook_payload_validation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callback',
+            name='object_id',
+            field=models.CharField(blank=True, max_length=256, null=True),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='coalesce_window',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds during which events of the same object update the waiting callback with their payload, instead of creating new callbacks. Leave empty to create a callback for every event.', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='callback',
+            index=models.Index(fields=['hook', 'object_id', 'status'], name='hooks_callb_hook_id_92c61f_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 10:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hooks', '0006_coalesce_callbacks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hook',
+            name='batch_format',
+            field=models.CharField(choices=[('json', 'JSON array'), ('ndjson', 'Newline delimited JSON')], default='json', help_text='Format of a batch request body', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='batch_max_bytes',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximal size of the payloads of a batch, in bytes', null=True),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='batch_max_events',
+            field=models.PositiveIntegerField(blank=True, help_text='Send up to this number of callbacks together in one request, as an array of their payloads. Leave empty to send each callback in its own request.', null=True),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='batch_max_wait',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds to wait for more callbacks before sending a partial batch. Leave empty to send partial batches immediately.', null=True),
+        ),
+    ]
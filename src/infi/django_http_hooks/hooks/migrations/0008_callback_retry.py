@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 10:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hooks', '0007_hook_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callback',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='callback',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='retry_backoff_base',
+            field=models.FloatField(default=60, help_text='Seconds to wait before the first retry'),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='retry_backoff_factor',
+            field=models.FloatField(default=2, help_text='The wait before each retry is multiplied by this factor'),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='retry_backoff_jitter',
+            field=models.FloatField(default=0.1, help_text='Random fraction of the wait to add or subtract, so retries of many callbacks are spread'),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='retry_max_attempts',
+            field=models.PositiveIntegerField(default=0, help_text='Number of times to retry sending a callback which failed. 0 means a failed callback is not retried.'),
+        ),
+        migrations.AddIndex(
+            model_name='callback',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='hooks_callb_status_232b00_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 10:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hooks', '0008_callback_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hook',
+            name='connect_timeout',
+            field=models.FloatField(blank=True, help_text='Seconds to wait for the connection to the target url. Leave empty for the default timeout.', null=True),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='read_timeout',
+            field=models.FloatField(blank=True, help_text='Seconds to wait for each read of the response. Leave empty for the default timeout.', null=True),
+        ),
+        migrations.AddField(
+            model_name='hook',
+            name='total_timeout',
+            field=models.FloatField(blank=True, help_text='Seconds to wait for the whole request, until the response is read. Leave empty for the default timeout.', null=True),
+        ),
+    ]
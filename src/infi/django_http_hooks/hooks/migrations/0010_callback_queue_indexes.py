@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 10:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hooks', '0009_hook_timeouts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='callback',
+            index=models.Index(fields=['status', 'hook', 'create_datetime'], name='hooks_callb_status_1e275a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='callback',
+            index=models.Index(fields=['status', 'update_datetime'], name='hooks_callb_status_a7314d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='callback',
+            index=models.Index(condition=models.Q(status__in=['waiting', 'error']), fields=['status', 'hook', 'next_attempt_at'], name='hooks_callback_pending_idx'),
+        ),
+    ]
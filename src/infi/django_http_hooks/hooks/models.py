@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+from django.template import Template, Context, TemplateSyntaxError
 
 
 
@@ -9,6 +13,14 @@ HTTP_METHODS = ['POST', 'PUT', 'PATCH', 'GET', 'DELETE']
 
 CONTENT_TYPES = ['application/json', 'application/xml', 'text/xml', 'text/plain','application/javascript', 'text/html']
 
+CALLBACK_STATUSES = ['waiting', 'in_progress', 'sent', 'error']
+
+BATCH_FORMATS = [('json', 'JSON array'), ('ndjson', 'Newline delimited JSON')]
+
+PAYLOAD_VALIDATIONS = [('always', 'Validate every payload'),
+                       ('sample', 'Validate a sample of the payloads'),
+                       ('on_save', 'Validate the payload template only when saving the hook')]
+
 class Signal(models.Model):
     signal              = models.CharField(max_length=256, unique=True, help_text='Full path of the signal class')
     update_time         = models.DateTimeField(null=True, blank=True, auto_now_add=True)
@@ -35,11 +47,53 @@ class Hook(models.Model):
     payload_template    = models.TextField(null=True, blank=True, help_text='Use {{}} for variables template. Placeholder names can be any attribute in the model using a prefix of "instance.". Leave empty for default payload. See documentation for further details.  ')
     serializer_class    = models.CharField(max_length=256, null=True, blank=True, help_text='Full path of the serializer class. Leave empty for default payload.')
     content_type        = models.CharField(max_length=128, null=True, blank=True, choices=[(c, c) for c in CONTENT_TYPES])
+    payload_validation  = models.CharField(max_length=32, default='always', choices=PAYLOAD_VALIDATIONS, help_text='When to validate payloads against the content type. Default and serializer JSON payloads are never validated.')
+    payload_validation_sample_rate = models.PositiveSmallIntegerField(default=10, help_text='Percent of the payloads to validate when validating a sample')
+
+    # Hook delivery details.
+    retry_max_attempts  = models.PositiveIntegerField(default=0, help_text='Number of times to retry sending a callback which failed. 0 means a failed callback is not retried.')
+    retry_backoff_base  = models.FloatField(default=60, help_text='Seconds to wait before the first retry')
+    retry_backoff_factor = models.FloatField(default=2, help_text='The wait before each retry is multiplied by this factor')
+    retry_backoff_jitter = models.FloatField(default=0.1, help_text='Random fraction of the wait to add or subtract, so retries of many callbacks are spread')
+    batch_max_events    = models.PositiveIntegerField(null=True, blank=True, help_text='Send up to this number of callbacks together in one request, as an array of their payloads. Leave empty to send each callback in its own request.')
+    batch_max_bytes     = models.PositiveIntegerField(null=True, blank=True, help_text='Maximal size of the payloads of a batch, in bytes')
+    batch_max_wait      = models.PositiveIntegerField(null=True, blank=True, help_text='Seconds to wait for more callbacks before sending a partial batch. Leave empty to send partial batches immediately.')
+    batch_format        = models.CharField(max_length=32, default='json', choices=BATCH_FORMATS, help_text='Format of a batch request body')
+    coalesce_window     = models.PositiveIntegerField(null=True, blank=True, help_text='Seconds during which events of the same object update the waiting callback with their payload, instead of creating new callbacks. Leave empty to create a callback for every event.')
+    connect_timeout     = models.FloatField(null=True, blank=True, help_text='Seconds to wait for the connection to the target url. Leave empty for the default timeout.')
+    read_timeout        = models.FloatField(null=True, blank=True, help_text='Seconds to wait for each read of the response. Leave empty for the default timeout.')
+    total_timeout       = models.FloatField(null=True, blank=True, help_text='Seconds to wait for the whole request, until the response is read. Leave empty for the default timeout.')
 
 
     def __str__(self):
         return '{name}({date})'.format(name=self.name or self.model.name, date=self.create_datetime.date())
 
+    def clean(self):
+        '''
+        reject an invalid serializer class or payload template when the hook is saved via a form, e.g. in the admin page.
+        The payload template is validated by rendering it with an unsaved sample instance of the model
+        '''
+        from infi.django_http_hooks.utils import import_path, validate_payload, get_sample_instance
+        from infi.django_http_hooks.exceptions import InvalidPayloadError
+        if self.serializer_class:
+            try:
+                import_path(self.serializer_class)
+            except ImportError as e:
+                raise ValidationError({'serializer_class': 'Cannot import serializer class: {}'.format(e)})
+
+        if self.payload_template:
+            try:
+                template = Template(self.payload_template)
+            except TemplateSyntaxError as e:
+                raise ValidationError({'payload_template': 'Invalid template: {}'.format(e)})
+            model_cls = self.model.model_class() if self.model_id else None
+            if model_cls is not None:
+                try:
+                    payload = template.render(Context(dict(instance=get_sample_instance(model_cls), event_type='updated')))
+                    validate_payload(payload, self.content_type)
+                except InvalidPayloadError as e:
+                    raise ValidationError({'payload_template': str(e)})
+
 
 class Callback(models.Model):
     update_datetime     = models.DateTimeField(null=True, blank=True, auto_now_add=True)
@@ -52,16 +106,40 @@ class Callback(models.Model):
     http_method         = models.CharField(max_length=64, null=True, blank=True, choices=[(m, m) for m in HTTP_METHODS])
 
     hook                = models.ForeignKey(Hook, on_delete=models.CASCADE)
+    # the primary key of the instance which triggered the hook
+    object_id           = models.CharField(max_length=256, null=True, blank=True)
 
-    status              = models.CharField(max_length=64, null=True, blank=True, choices=[('waiting', 'waiting'), ('sent', 'sent'), ('error', 'error')], default='waiting')
+    status              = models.CharField(max_length=64, null=True, blank=True, choices=[(s, s) for s in CALLBACK_STATUSES], default='waiting')
     # storing the error details - after trying to send the request
     status_details      = models.CharField(max_length=512, null=True, blank=True)
 
+    # the number of times sending the callback has been attempted, and when it may be sent (again)
+    attempts            = models.PositiveIntegerField(default=0)
+    next_attempt_at     = models.DateTimeField(null=True, blank=True, default=timezone.now)
+
+    # the sending process which claimed the callback (status='in_progress') and until when. Expired leases return to the queue
+    lease_owner         = models.CharField(max_length=256, null=True, blank=True)
+    lease_expires_at    = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'lease_expires_at']),
+            models.Index(fields=['hook', 'object_id', 'status']),
+            models.Index(fields=['status', 'next_attempt_at']),
+            models.Index(fields=['status', 'hook', 'create_datetime']),
+            models.Index(fields=['status', 'update_datetime']),
+            # the callbacks in the queue or failed are few compared to the sent ones. Created on databases which support partial indexes only
+            models.Index(fields=['status', 'hook', 'next_attempt_at'], name='hooks_callback_pending_idx', condition=Q(status__in=['waiting', 'error'])),
+        ]
+
     def __str__(self):
         return '{}_{}'.format(self.update_datetime, self.hook)
 
 
+class HooksVersion(models.Model):
+    '''A single row holding the version of the hooks configuration, used when DJANGO_HTTP_HOOKS_VERSION_BACKEND = 'db' '''
+    version             = models.BigIntegerField(default=0)
+    update_datetime     = models.DateTimeField(null=True, blank=True, auto_now=True)
 
-
-
-
+    def __str__(self):
+        return str(self.version)
@@ -1,18 +1,35 @@
 import logging
 import importlib
+import threading
+import time
 from subprocess import check_output
 from django.apps import apps
 from django.conf import settings
-from django.db import connection
-from django.db.models.signals import post_save, post_delete
-from infi.django_http_hooks.utils import create_callback
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from infi.django_http_hooks.utils import create_callback, create_callback_on_commit, template_cache, compile_hook
 from infi.django_http_hooks.api import create_signal
-from .models import Hook
+from infi.django_http_hooks.metrics import get_metrics
+from infi.django_http_hooks.exceptions import InvalidPayloadError
+from .models import Hook, HooksVersion
 
 logger = logging.getLogger(__name__)
 
 # stores all current hooks in memory
 hooks = {}
+# the signal and model class of each connected receiver, by the same keys of hooks
+receivers = {}
+# the version of the hooks configuration loaded into hooks (see DJANGO_HTTP_HOOKS_LIVE_RELOAD)
+hooks_version = None
+# the last time hooks_version was compared with the shared version
+hooks_version_checked_at = 0
+# serializes rebuilding hooks between threads
+hooks_lock = threading.RLock()
+
+HOOKS_VERSION_CACHE_KEY = 'django_http_hooks_version'
+DEFAULT_VERSION_CHECK_INTERVAL = 5
 
 
 def init():
@@ -22,16 +39,77 @@ def init():
     if 'hooks_hook' in all_tables:
         post_save.connect(invalidate_hooks, sender=Hook, weak=False)
         post_delete.connect(invalidate_hooks, sender=Hook, weak=False)
+        if live_reload_enabled():
+            # signals of an hook are saved after the hook itself, e.g. by the admin page
+            m2m_changed.connect(invalidate_hook_signals, sender=Hook.signals.through, weak=False)
         init_hooks()
 
 
+def live_reload_enabled():
+    return getattr(settings, 'DJANGO_HTTP_HOOKS_LIVE_RELOAD', False)
+
+
+def use_db_version():
+    return getattr(settings, 'DJANGO_HTTP_HOOKS_VERSION_BACKEND', 'cache') == 'db'
+
+
+def get_hooks_version():
+    '''the version of the hooks configuration shared by all processes, kept in the Django cache or in the HooksVersion table'''
+    if use_db_version():
+        return HooksVersion.objects.values_list('version', flat=True).first()
+    return cache.get(HOOKS_VERSION_CACHE_KEY)
+
+
+def bump_hooks_version():
+    '''let all processes sharing the cache (or the database) know that hooks have been changed'''
+    if use_db_version():
+        if not HooksVersion.objects.update(version=F('version') + 1):
+            HooksVersion.objects.create(version=1)
+        return get_hooks_version()
+    try:
+        return cache.incr(HOOKS_VERSION_CACHE_KEY)
+    except ValueError:
+        # the version is missing from the cache
+        cache.set(HOOKS_VERSION_CACHE_KEY, 1, timeout=None)
+        return 1
+
+
+def reload_hooks():
+    '''rebuild the hooks of the current process, and let other processes rebuild theirs on their next signal'''
+    bump_hooks_version()
+    init_hooks()
+
+
+def check_hooks_version():
+    '''
+    rebuild the hooks if they were changed by another process since they were loaded by this process.
+    The shared version is read at most once every DJANGO_HTTP_HOOKS_VERSION_CHECK_INTERVAL seconds
+    '''
+    global hooks_version_checked_at
+    now_ = time.monotonic()
+    if now_ - hooks_version_checked_at < getattr(settings, 'DJANGO_HTTP_HOOKS_VERSION_CHECK_INTERVAL', DEFAULT_VERSION_CHECK_INTERVAL):
+        return
+    hooks_version_checked_at = now_
+    if get_hooks_version() != hooks_version:
+        logger.info('Hooks have been changed by another process, reloading hooks')
+        init_hooks()
+
+
+def invalidate_hook_signals(action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_hooks(action=action, **kwargs)
+
+
 def invalidate_hooks(**kwargs):
     '''
-    Executes a custom command configured in the Django settings of the projects which is using django_http_hooks
+    If DJANGO_HTTP_HOOKS_LIVE_RELOAD is set, rebuilds the hooks in memory once the current transaction is committed.
+    Otherwise, executes a custom command configured in the Django settings of the projects which is using django_http_hooks
     Important: This executed command should reload the server
     '''
 
-    if hasattr(settings, 'DJANGO_HTTP_HOOKS_RELOAD') and settings.DJANGO_HTTP_HOOKS_RELOAD:
+    if live_reload_enabled():
+        transaction.on_commit(reload_hooks)
+    elif hasattr(settings, 'DJANGO_HTTP_HOOKS_RELOAD') and settings.DJANGO_HTTP_HOOKS_RELOAD:
         try:
             check_output(settings.DJANGO_HTTP_HOOKS_RELOAD)
         except Exception as e:
@@ -52,23 +130,43 @@ def invalidate_hooks(**kwargs):
 
 
 def init_hooks(**kwargs):
-    '''populate cached variable hooks with all records of Hook model. Should be called for every change in Hook'''
-    global hooks
-    hooks = {}
+    '''
+    populate cached variable hooks with all records of Hook model. Should be called for every change in Hook.
+    The new hooks are built aside and replace the current ones at once, so concurrent signals see either the old or the new hooks.
+    Only receivers of added or removed (model, signal) pairs are connected or disconnected.
+    '''
+    global hooks, hooks_version, hooks_version_checked_at
     # each key in hooks holds a list of all hooks related to the same model and signal
     try:
-        all_hooks = Hook.objects.all()
-        # go over all hooks and for each hook go over all its signals
-        for h in all_hooks:
-            # register only enabled hooks
-            if h.enabled:
+        with hooks_lock:
+            version = get_hooks_version()
+            new_hooks = {}
+            new_signals = {}
+            # register only enabled hooks. Models and signals are fetched together with the hooks, in a constant number of queries
+            all_hooks = Hook.objects.filter(enabled=True).select_related('model').prefetch_related('signals')
+            # go over all hooks and for each hook go over all its signals
+            for h in all_hooks:
+                # resolve the serializer class once, and report an invalid one as soon as the hook is registered
+                compiled = compile_hook(h)
+                if compiled.serializer_error:
+                    logger.error('Hook {}: {}'.format(h.id, compiled.serializer_error))
+                    # raise the exception only if it was configured in the project's settings
+                    if hasattr(settings, 'DJANGO_HTTP_HOOKS_RAISE_EXCEPTIONS') and settings.DJANGO_HTTP_HOOKS_RAISE_EXCEPTIONS:
+                        raise InvalidPayloadError('Hook {}: {}'.format(h.id, compiled.serializer_error))
                 for signal in h.signals.all():
                     key_ = '{}_{}'.format(h.model.model, signal.signal)
-                    hooks.setdefault(key_, [])
-                    # do not register a signal and a model more than once!
-                    if not hooks.get(key_):
-                        register_signal(signal.signal, h.model)
-                    hooks[key_].append(h)
+                    new_hooks.setdefault(key_, []).append(h)
+                    new_signals[key_] = (signal.signal, h.model)
+
+            # do not register a signal and a model more than once!
+            for key_ in set(new_hooks) - set(receivers):
+                receivers[key_] = register_signal(*new_signals[key_], dispatch_uid=key_)
+            hooks = new_hooks
+            hooks_version = version
+            template_cache.clear()
+            hooks_version_checked_at = time.monotonic()
+            for key_ in set(receivers) - set(new_hooks):
+                unregister_signal(key_, *receivers.pop(key_))
         return hooks
     except Exception as e:
         # raise the exception only if it was configured in the project's settings
@@ -77,9 +175,10 @@ def init_hooks(**kwargs):
             raise
 
 
-def register_signal(signal_name, model):
+def register_signal(signal_name, model, dispatch_uid=None):
     '''create a receiver with dynamic input of signal name
      signal_name is expected to be a comma separated string: <path.to.signal>
+     :return: the signal object and the model class the receiver is connected to
     '''
     # create an handler which knows to get signal_name
     handler_ = get_signal_handler_by_name(signal_name)
@@ -88,28 +187,45 @@ def register_signal(signal_name, model):
     s = create_signal(signal_name, create=False)
 
     model_cls = apps.get_model(app_label=model.app_label, model_name=model.model)
-    s.connect(handler_, weak=False, sender=model_cls)
+    s.connect(handler_, weak=False, sender=model_cls, dispatch_uid=dispatch_uid)
 
     logger.debug('registered signal {} with model {}'.format(signal_name, model.name))
+    return s, model_cls
+
+
+def unregister_signal(dispatch_uid, signal, model_cls):
+    '''disconnect a receiver created by register_signal'''
+    signal.disconnect(sender=model_cls, dispatch_uid=dispatch_uid)
+    logger.debug('unregistered signal {} of model {}'.format(dispatch_uid, model_cls.__name__))
 
 
 def handler(sender, signal_, **kwargs):
     '''being triggered by registered signals and create a callback according to the hook found in cached hooks'''
     try:
-        global hooks
+        if live_reload_enabled():
+            check_hooks_version()
         # search for the hook of the given sender and signal name according to key composed from signal_name & sender
         hook_key = '{}_{}'.format(sender.__name__.lower(), signal_)
 
         hooks_list = hooks.get(hook_key, [])
-        for hook in hooks_list:
-            # differentiate between post_save/pre_save caused by create event against update event
-            if 'save' in signal_:
-                event_type = 'created' if kwargs.get('created') else 'updated'
-            else:
-                # if the signal is not post_save/pre_save the event type will be just the signal
-                event_type = signal_
-
-            create_callback(hook, event_type=event_type, **kwargs)
+        if not hooks_list:
+            return
+        on_commit = getattr(settings, 'DJANGO_HTTP_HOOKS_ON_COMMIT', False)
+        metrics = get_metrics()
+        metrics.inc('django_http_hooks_events_total', signal=signal_)
+        with metrics.timer('django_http_hooks_handler_seconds', signal=signal_):
+            for hook in hooks_list:
+                # differentiate between post_save/pre_save caused by create event against update event
+                if 'save' in signal_:
+                    event_type = 'created' if kwargs.get('created') else 'updated'
+                else:
+                    # if the signal is not post_save/pre_save the event type will be just the signal
+                    event_type = signal_
+
+                if on_commit:
+                    create_callback_on_commit(hook, event_type=event_type, **kwargs)
+                else:
+                    create_callback(hook, event_type=event_type, **kwargs)
     except Exception as e:
         logger.error('Error in Signal handler: {}'.format(e))
         # raise the exception only if it was configured in the project's settings
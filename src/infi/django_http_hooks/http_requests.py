@@ -1,20 +1,132 @@
+import threading
+import time
 import requests
 import json
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.timeout import Timeout
 
 
-def send_request(url, method, **kwargs):
-    '''send http request according to given configuration, assuming headers and payload are valid jsons'''
-    headers = {}
-    if kwargs.get('headers'):
-        # headers are expected to be a valid json
-        headers = json.loads(kwargs['headers'])
-    # add content-type to the headers
-    if kwargs.get('content_type'):
-        headers['Content-Type'] = kwargs['content_type']
-
-    res = requests.request(method=method,
-                           url=url,
-                           headers=headers,
-                           data=kwargs.get('payload'))
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_TOTAL_TIMEOUT = 60
+# number of bytes read from the response body, the rest of it is not used
+DEFAULT_MAX_RESPONSE_BYTES = 256
+# number of bytes of the response body read to its end, so its connection returns to the pool. Longer responses close their connection
+DEFAULT_MAX_DRAIN_BYTES = 64 * 1024
+DRAIN_CHUNK_SIZE = 8192
+
+
+def get_host(url):
+    '''returns the scheme and the network location of the given url, e.g: https://example.com:8443'''
+    parts = urlsplit(url)
+    return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+class SessionPool(object):
+    '''
+    Keeps one keep-alive requests.Session per target host, so consecutive requests to the same host reuse their connections.
+    Sessions are shared between threads, each one holds up to pool_size open connections to its host.
+    '''
+
+    def __init__(self, pool_size=None):
+        self.pool_size = pool_size or DEFAULT_POOL_SIZE
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        host = get_host(url)
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._sessions[host] = session
+        return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+# used by send_request when no other pool is given
+default_pool = SessionPool()
+
+
+def get_timeouts(hook=None):
+    '''returns the connect, read and total timeouts of a request of the given hook: the timeouts of the hook, or the default timeouts from settings'''
+    defaults = (getattr(settings, 'DJANGO_HTTP_HOOKS_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+                getattr(settings, 'DJANGO_HTTP_HOOKS_READ_TIMEOUT', DEFAULT_READ_TIMEOUT),
+                getattr(settings, 'DJANGO_HTTP_HOOKS_TOTAL_TIMEOUT', DEFAULT_TOTAL_TIMEOUT))
+    if hook is None:
+        return defaults
+    hook_timeouts = (hook.connect_timeout, hook.read_timeout, hook.total_timeout)
+    return tuple(default if timeout is None else timeout for timeout, default in zip(hook_timeouts, defaults))
+
+
+def get_request_headers(headers=None, content_type=None):
+    '''returns the headers of a request, given as a valid json, together with its content type'''
+    request_headers = json.loads(headers) if headers else {}
+    if content_type:
+        request_headers['Content-Type'] = content_type
+    return request_headers
+
+
+def read_response(res, max_bytes, deadline=None, max_drain_bytes=0):
+    '''
+    read up to max_bytes of the body of the given streamed response, which are then available as res.content.
+    The rest of the body is read and dropped up to max_drain_bytes. A response which is read to its end returns its connection to the pool,
+    otherwise the connection is closed
+    '''
+    limit = max(max_bytes, max_drain_bytes)
+    content = b''
+    read = 0
+    completed = True
+    for chunk in res.iter_content(chunk_size=min(limit + 1, DRAIN_CHUNK_SIZE)):
+        read += len(chunk)
+        if len(content) <= max_bytes:
+            content += chunk[:max_bytes + 1 - len(content)]
+        if read > limit or (deadline and time.monotonic() > deadline):
+            completed = False
+            break
+    if not completed:
+        res.close()
+    # the body is not read again by requests
+    res._content = content[:max_bytes]
+    res._content_consumed = True
+    return res
+
+
+def send_request(url, method, pool=None, timeouts=None, max_response_bytes=None, max_drain_bytes=DEFAULT_MAX_DRAIN_BYTES, **kwargs):
+    '''
+    send http request according to given configuration, assuming headers and payload are valid jsons.
+    :param timeouts: connect, read and total timeouts in seconds. Default: the timeouts from settings. A timeout of None is not enforced.
+                     The total timeout cuts the connect and read timeouts to the time left, and with max_response_bytes the reading of the
+                     body, which is then truncated. A response which arrived is never failed by it
+    :param max_response_bytes: number of bytes to read from the response body. Default: the whole body
+    :param max_drain_bytes: with max_response_bytes, longer bodies are still read up to this number of bytes to keep their connection
+    '''
+    headers = get_request_headers(kwargs.get('headers'), kwargs.get('content_type'))
+
+    connect_timeout, read_timeout, total_timeout = timeouts or get_timeouts()
+    deadline = time.monotonic() + total_timeout if total_timeout else None
+
+    session = (pool or default_pool).get(url)
+    res = session.request(method=method,
+                          url=url,
+                          headers=headers,
+                          data=kwargs.get('payload'),
+                          timeout=Timeout(connect=connect_timeout, read=read_timeout, total=total_timeout or None),
+                          stream=max_response_bytes is not None)
+    if max_response_bytes is not None:
+        read_response(res, max_response_bytes, deadline, max_drain_bytes)
     res.raise_for_status()
-    return res
\ No newline at end of file
+    return res
@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import Count
+from django.http import HttpResponse, Http404
+from infi.django_http_hooks.hooks.models import Callback
+
+# the metrics recorded by django_http_hooks: name -> (type, help)
+METRICS = {
+    'django_http_hooks_events_total': ('counter', 'Events handled by the signal handler, by signal'),
+    'django_http_hooks_handler_seconds': ('histogram', 'Time spent in the signal handler per event, by signal'),
+    'django_http_hooks_payload_render_seconds': ('histogram', 'Time spent rendering a payload, by kind: template, serializer or default'),
+    'django_http_hooks_callback_insert_seconds': ('histogram', 'Time spent inserting callbacks, by mode: single or bulk'),
+    'django_http_hooks_callbacks_inserted_total': ('counter', 'Callbacks inserted, by mode: single or bulk'),
+    'django_http_hooks_delivery_seconds': ('histogram', 'Latency of the callback requests, by target host and status code'),
+    'django_http_hooks_deliveries_total': ('counter', 'Callback requests sent, by target host and status code'),
+    'django_http_hooks_queue_depth': ('gauge', 'Number of callbacks waiting, in progress or failed, by status'),
+}
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+# the statuses counted by the queue depth gauge. Sent callbacks are the history of the table, and counting them would scan most of it
+QUEUE_STATUSES = ('waiting', 'in_progress', 'error')
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+class NullMetrics(object):
+    '''the default metrics backend, which records nothing'''
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    @contextmanager
+    def timer(self, name, **labels):
+        yield
+
+    def render(self):
+        return None
+
+
+class PrometheusMetrics(NullMetrics):
+    '''
+    Keeps the metrics of the current process in memory, and renders them in the Prometheus text exposition format.
+    Each process (e.g. each gunicorn worker or callback worker) renders only its own metrics
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = dict(counts=[0] * len(self.buckets), sum=0.0, count=0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        '''returns the value of a counter or a gauge, or the count of the observations of a histogram'''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key]['count']
+            return self._values.get(key, 0)
+
+    def render(self):
+        with self._lock:
+            samples = {}
+            for (name, labels), value in self._values.items():
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['counts']):
+                    cumulative += count
+                    samples.setdefault(name, []).append((name + '_bucket', labels + (('le', format_value(bound)), ), cumulative))
+                samples[name] += [(name + '_bucket', labels + (('le', '+Inf'), ), histogram['count']),
+                                  (name + '_sum', labels, histogram['sum']),
+                                  (name + '_count', labels, histogram['count'])]
+        lines = []
+        for name in sorted(samples):
+            type_, help_ = METRICS.get(name, ('untyped', name))
+            lines += ['# HELP {} {}'.format(name, help_), '# TYPE {} {}'.format(name, type_)]
+            for sample_name, labels, value in samples[name]:
+                lines.append('{}{} {}'.format(sample_name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+BACKENDS = {
+    'prometheus': PrometheusMetrics,
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                                    for key, value in labels))
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def get_metrics():
+    '''
+    returns the metrics backend configured by DJANGO_HTTP_HOOKS_METRICS: None for no metrics, 'prometheus', or the full path of a class
+    implementing the methods of NullMetrics. The backend is created once per process
+    '''
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                backend = getattr(settings, 'DJANGO_HTTP_HOOKS_METRICS', None)
+                if not backend:
+                    _metrics = NullMetrics()
+                elif backend in BACKENDS:
+                    _metrics = BACKENDS[backend]()
+                else:
+                    from infi.django_http_hooks.utils import import_path
+                    _metrics = import_path(backend)()
+    return _metrics
+
+
+def reset_metrics(setting=None, **kwargs):
+    '''drop the metrics backend, so it is created again by the current settings'''
+    global _metrics
+    if setting in (None, 'DJANGO_HTTP_HOOKS_METRICS'):
+        _metrics = None
+
+
+setting_changed.connect(reset_metrics)
+
+
+def update_queue_depth():
+    '''set the queue depth gauge to the number of callbacks of each of QUEUE_STATUSES, counted by a single query'''
+    metrics = get_metrics()
+    callbacks = Callback.objects.filter(status__in=QUEUE_STATUSES).order_by()
+    counts = dict(callbacks.values_list('status').annotate(count=Count('id')))
+    for status in QUEUE_STATUSES:
+        metrics.set('django_http_hooks_queue_depth', counts.get(status, 0), status=status)
+
+
+def write_metrics(path):
+    '''write the metrics of the current process to the given file, e.g. for the node exporter textfile collector'''
+    text = get_metrics().render()
+    if text is None:
+        return
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    # replaced at once, so the file is never read half written
+    os.replace(temp_path, path)
+
+
+def metrics_view(request):
+    '''renders the metrics of the current process together with the queue depth, e.g: url(r'^metrics/$', metrics_view)'''
+    update_queue_depth()
+    text = get_metrics().render()
+    if text is None:
+        raise Http404('Metrics are switched off, see DJANGO_HTTP_HOOKS_METRICS')
+    return HttpResponse(text, content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,172 @@
+import re
+from datetime import datetime, timedelta
+from logging import getLogger
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from infi.django_http_hooks.hooks.models import Callback
+
+logger = getLogger(__name__)
+
+# the callbacks table may be partitioned by ranges of create_datetime on PostgreSQL 11 or later, so old callbacks are deleted by
+# dropping whole partitions instead of deleting their rows
+INTERVALS = ('day', 'month')
+DEFAULT_PERIODS_AHEAD = 7
+
+_bound_pattern = re.compile(r"FROM \((?P<from>[^)]+)\) TO \((?P<to>[^)]+)\)")
+
+
+def get_partition_interval():
+    '''the length of the partitions of the callbacks table: 'day' or 'month' '''
+    return getattr(settings, 'DJANGO_HTTP_HOOKS_CALLBACK_PARTITIONS', None) or 'day'
+
+
+def period_start(datetime_, interval):
+    '''returns the start of the partition period (day or month, in UTC) containing the given time'''
+    datetime_ = timezone.localtime(datetime_, timezone.utc)
+    if interval == 'month':
+        return datetime(datetime_.year, datetime_.month, 1, tzinfo=timezone.utc)
+    return datetime(datetime_.year, datetime_.month, datetime_.day, tzinfo=timezone.utc)
+
+
+def next_period(start, interval):
+    '''returns the start of the partition period following the one starting at start'''
+    if interval == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + timedelta(days=1)
+
+
+def get_partition_name(start, interval):
+    table_name = Callback._meta.db_table
+    return '{}_p{}'.format(table_name, start.strftime('%Y%m' if interval == 'month' else '%Y%m%d'))
+
+
+def parse_bound(value):
+    '''returns the time of a partition bound as printed by PostgreSQL, or None for MINVALUE and MAXVALUE'''
+    value = value.strip()
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return parse_datetime(value.strip("'"))
+
+
+def format_bound(datetime_):
+    '''returns the given time as a partition bound literal. Older PostgreSQL versions accept only literals as bounds, not parameters'''
+    return "'{}'".format(datetime_.isoformat())
+
+
+def parse_bounds(expression):
+    '''returns the lower and upper times of the given partition bound expression, e.g. FOR VALUES FROM ('...') TO ('...')'''
+    match = _bound_pattern.search(expression)
+    if match is None:
+        # the default partition
+        return None, None
+    return parse_bound(match.group('from')), parse_bound(match.group('to'))
+
+
+def is_partitioned():
+    '''returns whether the callbacks table is a partitioned table'''
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s',
+                       [Callback._meta.db_table])
+        return cursor.fetchone() is not None
+
+
+def get_partitions():
+    '''returns the name, the lower and upper times and whether it is the default partition, of each partition of the callbacks table'''
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits '
+                       'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                       'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                       'WHERE parent.relname = %s', [Callback._meta.db_table])
+        rows = cursor.fetchall()
+    return [(name, ) + parse_bounds(expression) + (expression == 'DEFAULT', ) for name, expression in rows]
+
+
+def create_partitions(interval=None, periods_ahead=DEFAULT_PERIODS_AHEAD, now_=None):
+    '''
+    create the partitions of the callbacks table from the current period up to periods_ahead periods ahead, skipping periods which are
+    covered by existing partitions. Should run regularly, so new callbacks never fall into the default partition.
+    :return: the names of the created partitions
+    '''
+    interval = interval or get_partition_interval()
+    qn = connection.ops.quote_name
+    existing = [(lower, upper) for name, lower, upper, default in get_partitions() if not default]
+    start = period_start(now_ or timezone.now(), interval)
+    created = []
+    for _ in range(periods_ahead + 1):
+        end = next_period(start, interval)
+        overlaps = any((lower is None or lower < end) and (upper is None or upper > start) for lower, upper in existing)
+        if not overlaps:
+            name = get_partition_name(start, interval)
+            with connection.cursor() as cursor:
+                cursor.execute('CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})'.format(
+                    qn(name), qn(Callback._meta.db_table), format_bound(start), format_bound(end)))
+            logger.info('Created partition {} of callbacks from {} to {}'.format(name, start, end))
+            created.append(name)
+        start = end
+    return created
+
+
+def drop_partitions(before):
+    '''
+    detach and drop the partitions of the callbacks table whose callbacks were all created before the given time. The default partition
+    is never dropped.
+    :return: the names of the dropped partitions
+    '''
+    qn = connection.ops.quote_name
+    dropped = []
+    for name, lower, upper, default in get_partitions():
+        if default or upper is None or upper > before:
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(qn(Callback._meta.db_table), qn(name)))
+            cursor.execute('DROP TABLE {}'.format(qn(name)))
+        logger.info('Dropped partition {} of callbacks created before {}'.format(name, upper))
+        dropped.append(name)
+    return dropped
+
+
+def convert_to_partitioned(interval=None, now_=None):
+    '''
+    replace the callbacks table by a table partitioned by create_datetime. The existing table becomes its first partition, holding the
+    callbacks created until the end of the current period, and a default partition holds callbacks which fall outside of all partitions.
+    The primary key of the partitioned table is (id, create_datetime), since PostgreSQL requires it to contain the partition key.
+    '''
+    interval = interval or get_partition_interval()
+    qn = connection.ops.quote_name
+    table_name = Callback._meta.db_table
+    legacy_name = '{}_legacy'.format(table_name)
+    legacy_end = next_period(period_start(now_ or timezone.now(), interval), interval)
+    with transaction.atomic(), connection.schema_editor() as schema_editor, connection.cursor() as cursor:
+        cursor.execute('UPDATE {} SET create_datetime = update_datetime WHERE create_datetime IS NULL'.format(qn(table_name)))
+        # the primary key of the partitioned table makes create_datetime not null, so a table with a nullable one cannot be attached
+        cursor.execute('ALTER TABLE {} ALTER COLUMN create_datetime SET NOT NULL'.format(qn(table_name)))
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(qn(table_name), qn(legacy_name)))
+        # index names are unique in the schema, so the indexes of the partitioned table may be named like the original ones
+        cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [legacy_name])
+        for (index_name, ) in cursor.fetchall():
+            cursor.execute('ALTER INDEX {} RENAME TO {}'.format(qn(index_name), qn(index_name[:55] + '_legacy')))
+
+        cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE (create_datetime)'.format(qn(table_name), qn(legacy_name)))
+        cursor.execute('ALTER TABLE {} ADD PRIMARY KEY (id, create_datetime)'.format(qn(table_name)))
+        # the new table shares the id sequence of the original table, which owns it. Otherwise the original table cannot be dropped once
+        # its callbacks are old, since the default id of the new table depends on the sequence
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [legacy_name])
+        sequence_name = cursor.fetchone()[0]
+        if sequence_name:
+            cursor.execute('ALTER SEQUENCE {} OWNED BY {}.{}'.format(sequence_name, qn(table_name), qn('id')))
+        hook_field = Callback._meta.get_field('hook')
+        cursor.execute('CREATE INDEX {} ON {} ({})'.format(qn('{}_hook_id_idx'.format(table_name)), qn(table_name), qn(hook_field.column)))
+        cursor.execute('ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {} ({}) DEFERRABLE INITIALLY DEFERRED'.format(
+            qn(table_name), qn(hook_field.column), qn(hook_field.related_model._meta.db_table), qn(hook_field.target_field.column)))
+        for index in Callback._meta.indexes:
+            schema_editor.add_index(Callback, index)
+
+        # attaching the original table creates the indexes of the partitioned table on it
+        cursor.execute('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (MINVALUE) TO ({})'.format(
+            qn(table_name), qn(legacy_name), format_bound(legacy_end)))
+        cursor.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(qn('{}_default'.format(table_name)), qn(table_name)))
+    logger.info('Converted {} to a table partitioned by create_datetime'.format(table_name))
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# dummy serializer to be used during tests, supporting to_representation like rest_framework serializers
+
+class NameSerializer(object):
+    def to_representation(self, instance):
+        return {'name': instance.name}
@@ -0,0 +1,197 @@
+import time
+import threading
+from logging import getLogger
+from unittest import mock, skipIf
+from django.template import Template, Context
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+from datetime import timedelta
+from infi.django_http_hooks.api import create_hook
+from infi.django_http_hooks.hooks import signals
+from infi.django_http_hooks.utils import set_payload, TemplateCache
+from infi.django_http_hooks.hooks.models import Callback
+from infi.django_http_hooks.dispatcher import create_dispatcher, claim_callbacks
+from infi.django_http_hooks.tests.wsgi_server import runserver
+from demo_app.models import ModelA
+from .test_signals import serialize_default_payload
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# models of the demo app, each hook is registered to one of them
+MODELS = ['modela', 'modelb', 'modelc', 'modeld', 'modele', 'modelf', 'modelg']
+SERVER_PORT = 8082
+
+# the results are logged at INFO level, so they are shown only when logging is configured to show them
+logger = getLogger(__name__)
+
+
+def report(name, seconds, iterations=1):
+    if iterations > 1:
+        logger.info('{}: {} iterations in {:.3f} seconds ({:.1f} microseconds per iteration)'.format(name, iterations, seconds, seconds * 1e6 / iterations))
+    else:
+        logger.info('{}: {:.3f} seconds'.format(name, seconds))
+
+
+class BenchmarkTestCase(TestCase):
+
+    # measuring the overhead of hooks. Each benchmark also asserts the property which keeps its cost bounded
+
+    def tearDown(self):
+        # the hooks created by the benchmarks are rolled back, so remove them from memory as well
+        signals.hooks = {}
+
+
+    def test_init_hooks_queries(self):
+        '''test that building the hooks takes a constant number of queries, regardless of the number of hooks'''
+        for i in range(len(MODELS)):
+            create_hook(signals=['django.db.models.signals.post_save', 'django.db.models.signals.post_delete'],
+                        model=MODELS[i],
+                        name='hook {}'.format(i))
+        # one query for the hooks with their models and one for their signals
+        with self.assertNumQueries(2):
+            signals.init_hooks()
+
+        for i in range(50):
+            create_hook(signals=['django.db.models.signals.post_save'], model=MODELS[i % len(MODELS)], name='hook {}'.format(i))
+        with self.assertNumQueries(2):
+            registered_hooks = signals.init_hooks()
+        self.assertEqual(sum([len(v) for v in registered_hooks.values()]), 2 * len(MODELS) + 50)
+
+
+    def test_init_hooks_benchmark(self):
+        '''startup benchmark: building hooks of many hooks'''
+        amount = 300
+        for i in range(amount):
+            create_hook(signals=['django.db.models.signals.post_save'], model=MODELS[i % len(MODELS)], name='hook {}'.format(i))
+        start = time.time()
+        signals.init_hooks()
+        report('init_hooks with {} hooks'.format(amount), time.time() - start)
+
+
+    def test_set_payload_template_cache_benchmark(self):
+        '''micro-benchmark: rendering a payload template with and without the compiled templates cache'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'],
+                           model='modela',
+                           content_type='application/json',
+                           payload_template='{"id": {{instance.id}}, "name": "{{instance.name}}", "event_type": "{{event_type}}" }')
+        instance = ModelA.objects.create(name='A')
+        iterations = 1000
+
+        start = time.time()
+        for i in range(iterations):
+            # the way set_payload rendered templates before caching them
+            Template(hook.payload_template).render(Context(dict(instance=instance, event_type='updated')))
+        report('template rendering without cache', time.time() - start, iterations)
+
+        cache = TemplateCache()
+        with mock.patch('infi.django_http_hooks.utils.template_cache', cache):
+            start = time.time()
+            for i in range(iterations):
+                set_payload(hook, instance=instance, event_type='updated')
+            report('set_payload with template cache', time.time() - start, iterations)
+
+        self.assertEqual(cache.info()['misses'], 1)
+        self.assertEqual(cache.info()['hits'], iterations - 1)
+
+
+    def test_template_cache_eviction(self):
+        '''test that the least recently used template is evicted, and that a changed template is compiled again'''
+        cache = TemplateCache(max_size=2)
+        hooks = [mock.Mock(id=i, payload_template='{{instance.id}}') for i in range(3)]
+        cache.get(hooks[0])
+        cache.get(hooks[1])
+        cache.get(hooks[0])
+        cache.get(hooks[2])
+        self.assertEqual(cache.info()['size'], 2)
+        # hook 1 is the least recently used
+        cache.get(hooks[1])
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+        hooks[0].payload_template = '{{instance.name}}'
+        self.assertEqual(cache.get(hooks[0]).render(Context(dict(instance=ModelA(name='A')))), 'A')
+        self.assertEqual(cache.misses, 5)
+
+
+    def test_default_payload_benchmark(self):
+        '''micro-benchmark: building the default payload directly, against serializing, parsing and serializing it again'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'], model='modela', content_type='application/json')
+        instance = ModelA.objects.create(name='A')
+        iterations = 1000
+
+        start = time.time()
+        for i in range(iterations):
+            serialize_default_payload(instance, 'updated')
+        report('default payload by serializers', time.time() - start, iterations)
+
+        start = time.time()
+        for i in range(iterations):
+            set_payload(hook, instance=instance, event_type='updated')
+        report('default payload by set_payload', time.time() - start, iterations)
+
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    def test_dispatcher_engines_benchmark(self):
+        '''throughput benchmark: sending callbacks to the gevent test server one by one, by threads and by asyncio'''
+        t = threading.Thread(target=runserver, kwargs=dict(port=SERVER_PORT))
+        t.daemon = True
+        t.start()
+        hook = create_hook(signals=['django.db.models.signals.post_save'],
+                           model='modela',
+                           target_url='http://127.0.0.1:{}'.format(SERVER_PORT),
+                           content_type='application/json',
+                           name='benchmark hook')
+        amount = 300
+        Callback.objects.bulk_create([Callback(hook=hook, target_url=hook.target_url, http_method='POST', content_type='application/json',
+                                               payload='{"index": %d}' % i) for i in range(amount)])
+
+        for engine, concurrency in (('threads', 1), ('threads', 8), ('asyncio', 64)):
+            Callback.objects.filter(hook=hook).update(status='waiting')
+            dispatcher = create_dispatcher(engine, concurrency=concurrency)
+            try:
+                stats = dispatcher.send(claim_callbacks('benchmark', hook_id=hook.id))
+            finally:
+                dispatcher.close()
+            self.assertEqual((stats.requests, stats.errors), (amount, 0))
+            logger.info('{} engine with concurrency {}: {} callbacks in {:.3f} seconds ({:.1f} callbacks/second)'.format(
+                engine, concurrency, stats.callbacks, stats.duration, stats.callbacks / stats.duration))
+
+
+    def assert_index_search(self, queryset, index=None):
+        '''assert that the callbacks table is searched by an index, rather than scanned, by the plan of the given query'''
+        plan = queryset.explain()
+        table_lines = [line for line in plan.splitlines() if Callback._meta.db_table in line]
+        self.assertTrue(table_lines, plan)
+        for line in table_lines:
+            self.assertIn('USING', line, plan)
+        if index:
+            self.assertIn(index, plan)
+
+
+    @skipIf(connection.vendor not in ('sqlite', 'postgresql'), 'query plans are asserted on sqlite and postgresql only')
+    def test_callback_queue_indexes_benchmark(self):
+        '''queue scans benchmark: the queries of the dispatcher and the monitor search the callbacks by indexes, regardless of the sent callbacks'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'], model='modela', name='queue hook')
+        now_ = timezone.now()
+        amount = 20000
+        # most callbacks were sent long ago, few are in the queue or failed
+        Callback.objects.bulk_create([Callback(hook=hook, target_url=hook.target_url, http_method='POST', payload='{}',
+                                               status='sent' if i % 100 else ('waiting' if i % 200 else 'error'),
+                                               create_datetime=now_, update_datetime=now_, next_attempt_at=now_) for i in range(amount)])
+
+        queue = Callback.objects.filter(status='waiting', next_attempt_at__lte=now_).order_by('id').values_list('id', flat=True)
+        self.assert_index_search(queue)
+        self.assert_index_search(queue.filter(hook_id=hook.id))
+        self.assert_index_search(Callback.objects.filter(status='error', update_datetime__gt=now_ - timedelta(minutes=10)))
+        self.assert_index_search(Callback.objects.filter(status='waiting', hook_id=hook.id).order_by('create_datetime'))
+
+        if connection.features.supports_partial_indexes:
+            with connection.cursor() as cursor:
+                self.assertIn('hooks_callback_pending_idx', connection.introspection.get_constraints(cursor, Callback._meta.db_table))
+
+        start = time.time()
+        for _ in range(100):
+            self.assertEqual(len(queue[:500]), amount // 200)
+        report('claiming from a queue of {} callbacks out of {}'.format(amount // 200, amount), time.time() - start, 100)
@@ -0,0 +1,686 @@
+import threading
+from io import StringIO
+import time
+from unittest import mock, skipIf
+from django.core.management import call_command, CommandError
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, OperationalError
+from django.utils import timezone
+from datetime import timedelta
+from infi.django_http_hooks.hooks.models import Hook, Callback
+import json
+from infi.django_http_hooks.dispatcher import Dispatcher, claim_callbacks, build_request, get_retry_delay, get_host_limits, HostLimiter
+from infi.django_http_hooks.tests.wsgi_server import runserver
+from infi.django_http_hooks.api import create_hook, get_callback_stats
+from infi.django_http_hooks.http_requests import get_timeouts, send_request, read_response, DEFAULT_MAX_DRAIN_BYTES
+import requests
+from requests.exceptions import ReadTimeout
+from infi.django_http_hooks.partitions import period_start, next_period, get_partition_name, parse_bounds, is_partitioned, get_partitions, \
+                                             create_partitions, drop_partitions, convert_to_partitioned
+from infi.django_http_hooks.circuit_breaker import CircuitBreaker, OPEN, CLOSED
+from infi.django_http_hooks.metrics import get_metrics
+from django.core.cache import cache
+from urllib3.connection import HTTPConnection
+try:
+    import httpx
+    from infi.django_http_hooks.async_dispatcher import AsyncDispatcher
+except ImportError:
+    httpx = None
+
+SERVER_PORT = 8081
+SERVER_URL = 'http://127.0.0.1:{}'.format(SERVER_PORT)
+# nothing listens on this port, so requests to it fail with connection error
+CLOSED_URL = 'http://127.0.0.1:1'
+
+
+class SendCallbacksTestCase(TestCase):
+
+    # testing the delivery of waiting callbacks by the send_callbacks process
+
+    @classmethod
+    def setUpClass(cls):
+        super(SendCallbacksTestCase, cls).setUpClass()
+        # run wsgi server to serve the sent requests
+        t = threading.Thread(target=runserver, kwargs=dict(port=SERVER_PORT))
+        t.daemon = True
+        t.start()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.hook = create_hook(signals=['django.db.models.signals.post_save'],
+                               model='modela',
+                               target_url=SERVER_URL,
+                               content_type='application/json',
+                               name='dispatcher hook')
+
+    def create_callbacks(self, amount, target_url=SERVER_URL, **kwargs):
+        # the callbacks load their hook from the database, since tests change the hook of the class
+        now_ = timezone.now()
+        return [Callback.objects.create(hook_id=self.hook.id,
+                                        target_url=target_url,
+                                        http_method='POST',
+                                        content_type='application/json',
+                                        payload='{"index": %d}' % i,
+                                        create_datetime=now_,
+                                        update_datetime=now_,
+                                        **kwargs) for i in range(amount)]
+
+
+    def test_send_callbacks(self):
+        '''test that send_callbacks sends all waiting callbacks and marks them as sent'''
+        self.create_callbacks(3)
+        call_command('send_callbacks')
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 3)
+        self.assertFalse(Callback.objects.filter(hook=self.hook, status='waiting'))
+
+
+    def test_concurrent_dispatcher(self):
+        '''test that sending callbacks in parallel updates each callback with its own response'''
+        callbacks = self.create_callbacks(10) + self.create_callbacks(2, target_url=CLOSED_URL)
+        dispatcher = Dispatcher(concurrency=4)
+        try:
+            stats = dispatcher.send(callbacks)
+        finally:
+            dispatcher.close()
+
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent', status_details='status_code:200').count(), 10)
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='error', target_url=CLOSED_URL).count(), 2)
+        self.assertEqual(stats.requests, 12)
+        self.assertEqual(stats.errors, 2)
+        self.assertEqual(stats.hosts[SERVER_URL].requests, 10)
+        self.assertEqual(stats.hosts[CLOSED_URL].errors, 2)
+
+
+    @mock.patch('infi.django_http_hooks.hooks.management.commands.run_callback_worker.close_old_connections')
+    def test_callback_worker(self, close_old_connections):
+        '''test that the callback worker keeps fetching batches until no waiting callback is left'''
+        # closing connections is irrelevant here and would break the transaction of the test
+        self.create_callbacks(5)
+        call_command('run_callback_worker', batch_size=2, exit_when_idle=True)
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 5)
+
+
+    @mock.patch('infi.django_http_hooks.hooks.management.commands.run_callback_worker.close_old_connections')
+    def test_callback_worker_metrics(self, close_old_connections):
+        '''test that the callback worker writes its metrics file once per metrics interval, rather than after each batch'''
+        self.create_callbacks(3)
+        module = 'infi.django_http_hooks.hooks.management.commands.run_callback_worker'
+        with mock.patch(module + '.update_queue_depth') as update_queue_depth, mock.patch(module + '.write_metrics') as write_metrics:
+            call_command('run_callback_worker', batch_size=1, exit_when_idle=True, metrics_file='metrics.prom', metrics_interval=60)
+            self.assertEqual((update_queue_depth.call_count, write_metrics.call_count), (1, 1))
+            self.create_callbacks(3)
+            call_command('run_callback_worker', batch_size=1, exit_when_idle=True, metrics_file='metrics.prom', metrics_interval=0)
+            # 3 batches and the empty one
+            self.assertEqual(write_metrics.call_count, 5)
+        write_metrics.assert_called_with('metrics.prom')
+
+
+    @mock.patch('infi.django_http_hooks.hooks.management.commands.run_callback_worker.close_old_connections')
+    def test_callback_worker_errors(self, close_old_connections):
+        '''test that the callback worker keeps running after a failed batch, e.g. when the database fails over'''
+        self.create_callbacks(3)
+        calls = []
+
+        def claim(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OperationalError('server closed the connection unexpectedly')
+            return claim_callbacks(*args, **kwargs)
+
+        with mock.patch('infi.django_http_hooks.hooks.management.commands.run_callback_worker.claim_callbacks', side_effect=claim), \
+             self.assertLogs('infi.django_http_hooks.hooks.management.commands.run_callback_worker', level='ERROR') as logs:
+            call_command('run_callback_worker', idle_sleep=0.01, exit_when_idle=True)
+        self.assertIn('Failed sending callbacks', logs.output[0])
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 3)
+
+
+    def test_claim_callbacks(self):
+        '''test that claimed callbacks cannot be claimed again by another sending process until their lease expires'''
+        self.create_callbacks(3)
+        claimed = claim_callbacks('worker-1', batch_size=2, hook_id=self.hook.id)
+        self.assertEqual(len(claimed), 2)
+        self.assertTrue(all(c.status == 'in_progress' and c.lease_owner == 'worker-1' for c in claimed))
+
+        # only the unclaimed callback is left for the second process
+        claimed_again = claim_callbacks('worker-2', hook_id=self.hook.id)
+        self.assertEqual(len(claimed_again), 1)
+        self.assertFalse(claim_callbacks('worker-3', hook_id=self.hook.id))
+
+        # expired leases return to the queue
+        Callback.objects.filter(lease_owner='worker-1').update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(claim_callbacks('worker-3', hook_id=self.hook.id)), 2)
+
+
+    def test_batched_delivery(self):
+        '''test that callbacks of a batched hook are sent together, as an array of their payloads'''
+        Hook.objects.filter(id=self.hook.id).update(batch_max_events=3)
+        callbacks = self.create_callbacks(7)
+        self.assertEqual(json.loads(build_request(callbacks[:3])['payload']), [{'index': 0}, {'index': 1}, {'index': 2}])
+
+        dispatcher = Dispatcher()
+        stats = dispatcher.send(claim_callbacks('worker', hook_id=self.hook.id))
+        dispatcher.close()
+        self.assertEqual(stats.requests, 3)
+        self.assertEqual(stats.callbacks, 7)
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 7)
+
+
+    def test_batch_limits(self):
+        '''test that a partial batch waits for more callbacks, and that batches are limited by the size of their payloads'''
+        Hook.objects.filter(id=self.hook.id).update(batch_max_events=10, batch_max_bytes=30, batch_max_wait=60, batch_format='ndjson')
+        callbacks = self.create_callbacks(3)
+        request = build_request(callbacks[:2])
+        self.assertEqual(request['payload'], '{"index": 0}\n{"index": 1}\n')
+        self.assertEqual(request['content_type'], 'application/x-ndjson')
+
+        # each payload takes 13 bytes, so a batch holds up to 2 payloads. The last batch is partial and is deferred
+        stats = Dispatcher().send(claim_callbacks('worker', hook_id=self.hook.id))
+        self.assertEqual((stats.requests, stats.callbacks, stats.deferred), (1, 2, 1))
+        deferred = Callback.objects.get(hook=self.hook, status='waiting')
+        # the deferred callback is not claimed again before the batch_max_wait of the oldest callback passes
+        self.assertEqual(deferred.next_attempt_at, deferred.create_datetime + timedelta(seconds=60))
+        self.assertFalse(claim_callbacks('worker', hook_id=self.hook.id))
+
+        # once the oldest callback waits longer than batch_max_wait, the partial batch is sent
+        Callback.objects.filter(hook=self.hook).update(create_datetime=timezone.now() - timedelta(seconds=61), next_attempt_at=timezone.now())
+        call_command('send_callbacks')
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 3)
+
+
+    def test_claim_without_next_attempt(self):
+        '''test that callbacks inserted without next_attempt_at are claimed, the same as due callbacks'''
+        callbacks = self.create_callbacks(2)
+        Callback.objects.filter(id=callbacks[0].id).update(next_attempt_at=None)
+        Callback.objects.filter(id=callbacks[1].id).update(next_attempt_at=timezone.now() + timedelta(minutes=5))
+        self.assertEqual([c.id for c in claim_callbacks('worker', hook_id=self.hook.id)], [callbacks[0].id])
+
+
+    def test_retry_backoff(self):
+        '''test that failed callbacks are retried after an exponential delay, and set to error after the last attempt'''
+        Hook.objects.filter(id=self.hook.id).update(retry_max_attempts=2, retry_backoff_base=10, retry_backoff_factor=3, retry_backoff_jitter=0)
+        hook = Hook.objects.get(id=self.hook.id)
+        self.assertEqual([get_retry_delay(hook, attempts) for attempts in (1, 2, 3)], [10, 30, 90])
+        callback = self.create_callbacks(1, target_url=CLOSED_URL)[0]
+
+        call_command('send_callbacks')
+        callback.refresh_from_db()
+        self.assertEqual((callback.status, callback.attempts), ('waiting', 1))
+        self.assertAlmostEqual((callback.next_attempt_at - callback.update_datetime).total_seconds(), 10, places=3)
+        # the callback is not sent again before its retry time
+        self.assertFalse(claim_callbacks('worker', hook_id=self.hook.id))
+
+        for attempts, status in ((2, 'waiting'), (3, 'error')):
+            Callback.objects.filter(id=callback.id).update(next_attempt_at=timezone.now())
+            call_command('send_callbacks')
+            callback.refresh_from_db()
+            self.assertEqual((callback.status, callback.attempts), (status, attempts))
+        self.assertTrue(callback.status_details.startswith('status_code:#N/A'))
+
+
+    def test_send_given_callbacks(self):
+        '''test that callbacks given by id are sent before their retry time, and attempted only once'''
+        Hook.objects.filter(id=self.hook.id).update(retry_max_attempts=5)
+        callbacks = self.create_callbacks(2, target_url=CLOSED_URL, next_attempt_at=timezone.now() + timedelta(hours=1))
+        call_command('send_callbacks', callbacks=[str(c.id) for c in callbacks])
+        self.assertEqual(list(Callback.objects.filter(hook=self.hook).values_list('attempts', flat=True)), [1, 1])
+
+
+    def test_host_limits(self):
+        '''test the lookup of the limits of a host and the token bucket of the limiter'''
+        limits = {'*': {'max_in_flight': 4}, '127.0.0.1:1': {'rate': 1}, SERVER_URL: {'rate': 2, 'max_in_flight': 1}}
+        with override_settings(DJANGO_HTTP_HOOKS_HOST_LIMITS=limits):
+            self.assertEqual(get_host_limits(SERVER_URL), {'rate': 2, 'max_in_flight': 1})
+            self.assertEqual(get_host_limits(CLOSED_URL), {'rate': 1})
+            self.assertEqual(get_host_limits('https://example.com'), {'max_in_flight': 4})
+
+        limiter = HostLimiter(rate=2, burst=2)
+        for _ in range(2):
+            self.assertEqual(limiter.wait_time(), 0)
+            limiter.acquire()
+        self.assertAlmostEqual(limiter.wait_time(), 0.5, places=2)
+        limiter = HostLimiter(max_in_flight=1)
+        limiter.acquire()
+        self.assertIsNone(limiter.wait_time())
+        limiter.release()
+        self.assertEqual(limiter.wait_time(), 0)
+
+
+    def test_rate_limit(self):
+        '''test that requests to a host are sent at its rate limit, and that callbacks exceeding it return to the queue without an error'''
+        self.create_callbacks(4)
+        with override_settings(DJANGO_HTTP_HOOKS_HOST_LIMITS={SERVER_URL: {'rate': 20, 'burst': 1}}):
+            stats = Dispatcher().send(claim_callbacks('worker', hook_id=self.hook.id))
+        # the first request uses the burst and each other one waits 1/20 second
+        self.assertGreaterEqual(stats.duration, 0.14)
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 4)
+
+        self.create_callbacks(3)
+        with override_settings(DJANGO_HTTP_HOOKS_HOST_LIMITS={SERVER_URL: {'rate': 1}}):
+            stats = Dispatcher(max_throttle_wait=0).send(claim_callbacks('worker', hook_id=self.hook.id))
+        self.assertEqual((stats.requests, stats.errors, stats.throttled), (1, 0, 2))
+        throttled = Callback.objects.filter(hook=self.hook, status='waiting')
+        self.assertEqual(throttled.count(), 2)
+        self.assertTrue(all(c.attempts == 0 and c.next_attempt_at > timezone.now() for c in throttled))
+
+
+    def test_rate_limit_with_slow_requests(self):
+        '''test that requests waiting for a free worker behind slow requests are still sent at the rate limit of their host'''
+        self.create_callbacks(2, headers='{"test-delay": "0.3"}')
+        self.create_callbacks(4)
+        dispatcher = Dispatcher(concurrency=2)
+        deliver = dispatcher._deliver
+        lock, sent_at = threading.Lock(), []
+
+        def timed_deliver(request):
+            with lock:
+                sent_at.append(time.monotonic())
+            return deliver(request)
+
+        dispatcher._deliver = timed_deliver
+        with override_settings(DJANGO_HTTP_HOOKS_HOST_LIMITS={SERVER_URL: {'rate': 10, 'burst': 1}}):
+            dispatcher.send(claim_callbacks('worker', hook_id=self.hook.id))
+        dispatcher.close()
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 6)
+        sent_at.sort()
+        self.assertGreaterEqual(min(b - a for a, b in zip(sent_at, sent_at[1:])), 0.08)
+
+
+    def test_max_in_flight(self):
+        '''test that the requests sent at the same time to a host do not exceed its max_in_flight'''
+        self.create_callbacks(6)
+        dispatcher = Dispatcher(concurrency=4)
+        deliver = dispatcher._deliver
+        lock, counters = threading.Lock(), dict(current=0, max=0)
+
+        def counting_deliver(request):
+            with lock:
+                counters['current'] += 1
+                counters['max'] = max(counters['max'], counters['current'])
+            time.sleep(0.01)
+            try:
+                return deliver(request)
+            finally:
+                with lock:
+                    counters['current'] -= 1
+
+        dispatcher._deliver = counting_deliver
+        with override_settings(DJANGO_HTTP_HOOKS_HOST_LIMITS={'*': {'max_in_flight': 2}}):
+            stats = dispatcher.send(claim_callbacks('worker', hook_id=self.hook.id))
+        dispatcher.close()
+        self.assertEqual(stats.requests, 6)
+        self.assertEqual(counters['max'], 2)
+
+
+    @override_settings(DJANGO_HTTP_HOOKS_CIRCUIT_BREAKER={'failure_threshold': 2, 'reset_timeout': 60})
+    def test_circuit_breaker(self):
+        '''test that callbacks of a failing host are skipped once its breaker opens, until a probe request is allowed'''
+        self.create_callbacks(5, target_url=CLOSED_URL)
+        dispatcher = Dispatcher()
+        stats = dispatcher.send(claim_callbacks('worker', hook_id=self.hook.id))
+        self.assertEqual((stats.requests, stats.errors, stats.skipped), (2, 2, 3))
+        self.assertEqual(dispatcher.breaker.get_state(CLOSED_URL)['state'], OPEN)
+        skipped = Callback.objects.filter(hook=self.hook, status='waiting')
+        self.assertEqual(skipped.count(), 3)
+        self.assertTrue(all(c.attempts == 0 and c.next_attempt_at > timezone.now() + timedelta(seconds=50) for c in skipped))
+
+        # after reset_timeout a single probe is sent, and its failure opens the breaker again
+        dispatcher.breaker.get_state(CLOSED_URL)['opened_at'] -= 61
+        Callback.objects.filter(hook=self.hook).update(next_attempt_at=timezone.now())
+        stats = dispatcher.send(claim_callbacks('worker', hook_id=self.hook.id))
+        self.assertEqual((stats.requests, stats.skipped), (1, 2))
+        self.assertEqual(dispatcher.breaker.get_state(CLOSED_URL)['state'], OPEN)
+
+        # a successful probe closes the breaker
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record(SERVER_URL, True)
+        breaker.get_state(SERVER_URL)['opened_at'] -= 61
+        self.assertTrue(breaker.allow(SERVER_URL))
+        self.assertFalse(breaker.allow(SERVER_URL))
+        breaker.record(SERVER_URL, False)
+        self.assertEqual(breaker.get_state(SERVER_URL), dict(state=CLOSED, failures=0, opened_at=None))
+
+
+    @override_settings(DJANGO_HTTP_HOOKS_CIRCUIT_BREAKER={'failure_threshold': 2, 'reset_timeout': 60})
+    def test_circuit_breaker_concurrency(self):
+        '''test that the breaker skips the requests of a failing host also when the requests are sent in parallel'''
+        self.create_callbacks(40, target_url=CLOSED_URL)
+        dispatcher = Dispatcher(concurrency=4)
+        try:
+            stats = dispatcher.send(claim_callbacks('worker', hook_id=self.hook.id))
+        finally:
+            dispatcher.close()
+        # only the requests sent before the second failure opened the breaker: up to a request per worker, and one more after the first failure
+        self.assertLessEqual(stats.requests, 5)
+        self.assertEqual(stats.skipped, 40 - stats.requests)
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='waiting', attempts=0).count(), stats.skipped)
+
+
+    @override_settings(DJANGO_HTTP_HOOKS_CIRCUIT_BREAKER={'failure_threshold': 1, 'backend': 'cache'})
+    def test_shared_circuit_breaker(self):
+        '''test that a breaker kept in the cache is shared by all dispatchers and reported by monitor_callbacks'''
+        self.addCleanup(cache.clear)
+        self.create_callbacks(2, target_url=CLOSED_URL)
+        Dispatcher().send(claim_callbacks('worker', batch_size=1, hook_id=self.hook.id))
+        stats = Dispatcher().send(claim_callbacks('worker', hook_id=self.hook.id))
+        self.assertEqual((stats.requests, stats.skipped), (0, 1))
+
+        with self.assertLogs('infi.django_http_hooks.hooks.management.commands.monitor_callbacks', level='WARNING') as logs:
+            call_command('monitor_callbacks', status='error', callbacks_limit=10)
+        self.assertIn('Circuit breaker of {} is open after 1 consecutive failures'.format(CLOSED_URL), logs.output[0])
+
+
+    def test_circuit_breaker_settings(self):
+        '''test that the circuit breaker is switched off unless configured, and that exceeding the total timeout fails the host'''
+        self.assertIsNone(Dispatcher().breaker)
+        with override_settings(DJANGO_HTTP_HOOKS_CIRCUIT_BREAKER={'failure_threshold': 1}):
+            dispatcher = Dispatcher()
+        Hook.objects.filter(id=self.hook.id).update(read_timeout=5, total_timeout=0.2)
+        self.create_callbacks(1, headers='{"test-delay": "0.5"}')
+        dispatcher.send(claim_callbacks('worker', hook_id=self.hook.id))
+        callback = Callback.objects.get(hook=self.hook)
+        self.assertIn('Read timed out', callback.status_details)
+        self.assertEqual(dispatcher.breaker.get_state(SERVER_URL)['state'], OPEN)
+
+
+    def test_total_timeout(self):
+        '''test that the total timeout cuts a receiver which is slow to answer, and never fails a response which arrived in time'''
+        start = time.monotonic()
+        with self.assertRaises(ReadTimeout):
+            send_request(SERVER_URL, 'POST', timeouts=(5, 5, 0.2), headers='{"test-delay": "1"}')
+        self.assertLess(time.monotonic() - start, 0.6)
+
+        res = send_request(SERVER_URL, 'POST', timeouts=(5, 5, 0.5), headers='{"test-delay": "0.1"}')
+        self.assertEqual(res.status_code, 200)
+
+        # a body which is read past the total timeout is truncated, and its request still succeeds
+        res = requests.post(SERVER_URL, data='x' * 100000, stream=True)
+        read_response(res, 20, deadline=time.monotonic() - 1, max_drain_bytes=DEFAULT_MAX_DRAIN_BYTES)
+        self.assertEqual(res.content, b'{"http_method": "POS')
+        res.raise_for_status()
+
+        Hook.objects.filter(id=self.hook.id).update(read_timeout=5, total_timeout=0.5)
+        self.create_callbacks(1, headers='{"test-delay": "0.1"}')
+        Dispatcher().send(claim_callbacks('worker', hook_id=self.hook.id))
+        callback = Callback.objects.get(hook=self.hook)
+        self.assertEqual((callback.status, callback.attempts), ('sent', 1))
+
+
+    @override_settings(DJANGO_HTTP_HOOKS_READ_TIMEOUT=10)
+    def test_timeouts(self):
+        '''test that a receiver which does not answer within the read timeout of the hook fails the callback, which is then retried'''
+        Hook.objects.filter(id=self.hook.id).update(read_timeout=0.2, retry_max_attempts=1)
+        hook = Hook.objects.get(id=self.hook.id)
+        self.assertEqual(get_timeouts(hook), (5, 0.2, 60))
+        self.assertEqual(get_timeouts(), (5, 10, 60))
+
+        self.create_callbacks(1, headers='{"test-delay": "2"}')
+        stats = Dispatcher().send(claim_callbacks('worker', hook_id=self.hook.id))
+        self.assertLess(stats.duration, 1)
+        callback = Callback.objects.get(hook=self.hook)
+        self.assertEqual((callback.status, callback.attempts), ('waiting', 1))
+        self.assertIn('Read timed out', callback.status_details)
+
+
+    @override_settings(DJANGO_HTTP_HOOKS_MAX_RESPONSE_BYTES=20)
+    def test_response_prefix(self):
+        '''test that only the beginning of the response body of a failed request is read, and kept in the status details'''
+        self.create_callbacks(1, headers='{"test-status": "500"}')
+        Dispatcher().send(claim_callbacks('worker', hook_id=self.hook.id))
+        callback = Callback.objects.get(hook=self.hook)
+        self.assertEqual(callback.status, 'error')
+        self.assertTrue(callback.status_details.startswith('status_code:500-500 Server Error'))
+        self.assertTrue(callback.status_details.endswith('-{"http_method": "POS'))
+
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    @override_settings(DJANGO_HTTP_HOOKS_MAX_RESPONSE_BYTES=20)
+    def test_async_dispatcher(self):
+        '''test that the asyncio engine updates the callbacks exactly like the threads engine'''
+        self.create_callbacks(10)
+        self.create_callbacks(2, target_url=CLOSED_URL)
+        self.create_callbacks(1, headers='{"test-status": "500"}')
+        dispatcher = AsyncDispatcher(concurrency=4)
+        try:
+            stats = dispatcher.send(claim_callbacks('worker', hook_id=self.hook.id))
+        finally:
+            dispatcher.close()
+
+        self.assertEqual((stats.requests, stats.errors), (13, 3))
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent', status_details='status_code:200').count(), 10)
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='error', target_url=CLOSED_URL).count(), 2)
+        failed = Callback.objects.get(hook=self.hook, status='error', target_url=SERVER_URL)
+        self.assertTrue(failed.status_details.startswith('status_code:500-500 Test Status'))
+        self.assertTrue(failed.status_details.endswith('-{"http_method": "POS'))
+
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    def test_async_engine_command(self):
+        '''test that send_callbacks sends the callbacks by the asyncio engine, keeping to the timeouts of the hook'''
+        Hook.objects.filter(id=self.hook.id).update(read_timeout=0.2, retry_max_attempts=1)
+        self.create_callbacks(3)
+        self.create_callbacks(1, headers='{"test-delay": "2"}')
+        call_command('send_callbacks', engine='asyncio')
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 3)
+        delayed = Callback.objects.get(hook=self.hook, status='waiting')
+        self.assertEqual(delayed.attempts, 1)
+        self.assertIn('ReadTimeout', delayed.status_details)
+
+
+    @override_settings(DJANGO_HTTP_HOOKS_METRICS='prometheus')
+    def test_delivery_metrics(self):
+        '''test that the latency of the requests is measured by target host and status code'''
+        self.create_callbacks(3)
+        self.create_callbacks(1, headers='{"test-status": "500"}')
+        self.create_callbacks(1, target_url=CLOSED_URL)
+        Dispatcher().send(claim_callbacks('worker', hook_id=self.hook.id))
+
+        metrics = get_metrics()
+        self.assertEqual(metrics.get('django_http_hooks_deliveries_total', host=SERVER_URL, status=200), 3)
+        self.assertEqual(metrics.get('django_http_hooks_delivery_seconds', host=SERVER_URL, status=500), 1)
+        self.assertEqual(metrics.get('django_http_hooks_deliveries_total', host=CLOSED_URL, status='none'), 1)
+        self.assertIn('django_http_hooks_deliveries_total{{host="{}",status="200"}} 3'.format(SERVER_URL), metrics.render())
+
+
+    def test_long_responses_keep_connections(self):
+        '''test that responses longer than the kept prefix are read to their end, so their connection is reused'''
+        now_ = timezone.now()
+        callbacks = [Callback.objects.create(hook_id=self.hook.id, target_url=SERVER_URL, http_method='POST', content_type='application/json',
+                                             payload=json.dumps(dict(index=i, data='x' * 600)), create_datetime=now_, update_datetime=now_)
+                     for i in range(20)]
+        with mock.patch.object(HTTPConnection, 'connect', autospec=True, side_effect=HTTPConnection.connect) as connect:
+            dispatcher = Dispatcher()
+            try:
+                dispatcher.send(callbacks)
+            finally:
+                dispatcher.close()
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 20)
+        self.assertEqual(connect.call_count, 1)
+
+
+    def test_batched_write_back(self):
+        '''test that the results of the sent callbacks are written back in a single statement, which updates only their result columns'''
+        self.create_callbacks(20)
+        self.create_callbacks(2, target_url=CLOSED_URL)
+        callbacks = claim_callbacks('worker', hook_id=self.hook.id)
+        with CaptureQueriesContext(connection) as queries:
+            Dispatcher().send(callbacks)
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"payload"', updates[0])
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='sent').count(), 20)
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='error', attempts=1, lease_owner=None).count(), 2)
+
+
+
+class DeleteOldCallbacksTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.hook = create_hook(signals=['django.db.models.signals.post_save'], model='modela', name='retention hook')
+
+    def create_callbacks(self, days_ago, status, amount=1):
+        callbacks = [Callback.objects.create(hook_id=self.hook.id, target_url=self.hook.target_url, status=status) for i in range(amount)]
+        Callback.objects.filter(id__in=[c.id for c in callbacks]).update(create_datetime=timezone.now() - timedelta(days=days_ago))
+        return callbacks
+
+
+    def test_delete_old_callbacks(self):
+        '''test that old callbacks are deleted in batches of ids, and that the new ones are kept'''
+        self.create_callbacks(40, 'sent', amount=7)
+        self.create_callbacks(40, 'error', amount=2)
+        new = self.create_callbacks(1, 'sent', amount=3)
+        with CaptureQueriesContext(connection) as queries:
+            call_command('delete_old_callbacks', 30, batch_size=3)
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('DELETE')]), 3)
+        self.assertEqual(set(Callback.objects.values_list('id', flat=True)), set(c.id for c in new))
+
+
+    def test_delete_old_callbacks_by_status(self):
+        '''test that only old callbacks with the given statuses are deleted'''
+        self.create_callbacks(40, 'sent', amount=2)
+        errors = self.create_callbacks(40, 'error', amount=2)
+        call_command('delete_old_callbacks', 30, status=['sent'])
+        self.assertEqual(set(Callback.objects.values_list('id', flat=True)), set(c.id for c in errors))
+        call_command('delete_old_callbacks', 30, status=['sent'])
+        self.assertEqual(Callback.objects.count(), 2)
+
+
+    def test_partition_periods(self):
+        '''test the periods and the bounds of the partitions of the callbacks table'''
+        now_ = timezone.datetime(2026, 12, 31, 23, 30, tzinfo=timezone.utc)
+        day, month = period_start(now_, 'day'), period_start(now_, 'month')
+        self.assertEqual(day, timezone.datetime(2026, 12, 31, tzinfo=timezone.utc))
+        self.assertEqual(next_period(day, 'day'), timezone.datetime(2027, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(next_period(month, 'month'), timezone.datetime(2027, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(get_partition_name(month, 'month'), 'hooks_callback_p202612')
+        self.assertEqual(get_partition_name(day, 'day'), 'hooks_callback_p20261231')
+
+        self.assertEqual(parse_bounds("FOR VALUES FROM ('2026-12-31 00:00:00+00') TO ('2027-01-01 00:00:00+00')"),
+                         (day, next_period(day, 'day')))
+        self.assertEqual(parse_bounds("FOR VALUES FROM (MINVALUE) TO ('2026-12-31 00:00:00+00')"), (None, day))
+        self.assertEqual(parse_bounds('DEFAULT'), (None, None))
+
+
+    @skipIf(connection.vendor == 'postgresql', 'partitioning is supported on postgresql')
+    def test_partitions_require_postgresql(self):
+        '''test that partitions are not created on other databases, where old callbacks are deleted in batches'''
+        with self.assertRaises(CommandError):
+            call_command('create_callback_partitions', convert=True)
+
+
+
+@skipIf(connection.vendor != 'postgresql', 'partitioning is supported on postgresql')
+class CallbackPartitionsTestCase(TestCase):
+
+    # testing the partitioned callbacks table. The DDL is rolled back together with the transaction of each test
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.hook = create_hook(signals=['django.db.models.signals.post_save'], model='modela', name='partitioned hook')
+
+    def setUp(self):
+        # tables with pending deferred constraint checks cannot be altered in the same transaction
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    def create_callback(self, days_ago=0):
+        callback = Callback.objects.create(hook_id=self.hook.id, target_url=self.hook.target_url, status='sent')
+        Callback.objects.filter(id=callback.id).update(create_datetime=timezone.now() - timedelta(days=days_ago))
+        return callback
+
+
+    def test_convert_to_partitioned(self):
+        '''test that converting the callbacks table keeps its callbacks and its id sequence'''
+        old = self.create_callback(days_ago=3)
+        # the partition key is not null in the partitioned table, so missing creation times are filled by the update times
+        undated = self.create_callback()
+        Callback.objects.filter(id=undated.id).update(create_datetime=None)
+        call_command('create_callback_partitions', convert=True, ahead=2)
+        undated.refresh_from_db()
+        self.assertEqual(undated.create_datetime, undated.update_datetime)
+        self.assertTrue(is_partitioned())
+        names = set(name for name, lower, upper, default in get_partitions())
+        today = period_start(timezone.now(), 'day')
+        self.assertEqual(names, {'hooks_callback_legacy', 'hooks_callback_default', get_partition_name(next_period(today, 'day'), 'day'),
+                                 get_partition_name(next_period(next_period(today, 'day'), 'day'), 'day')})
+        self.assertTrue(Callback.objects.filter(id=old.id).exists())
+        self.assertGreater(self.create_callback().id, old.id)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_get_serial_sequence('hooks_callback', 'id')")
+            self.assertIsNotNone(cursor.fetchone()[0])
+
+
+    def test_create_partitions(self):
+        '''test that partitions are created only for periods which are not covered yet'''
+        convert_to_partitioned('day', now_=timezone.now() - timedelta(days=10))
+        created = create_partitions('day', 2)
+        self.assertEqual(len(created), 3)
+        self.assertEqual(create_partitions('day', 2), [])
+        self.assertEqual(create_partitions('day', 3), [get_partition_name(period_start(timezone.now() + timedelta(days=3), 'day'), 'day')])
+
+
+    def test_drop_partitions(self):
+        '''test that partitions of old callbacks are dropped, including the original table, and new callbacks are kept'''
+        old = self.create_callback(days_ago=20)
+        convert_to_partitioned('day', now_=timezone.now() - timedelta(days=10))
+        create_partitions('day', 1)
+        new = self.create_callback()
+        self.assertEqual(drop_partitions(timezone.now() - timedelta(days=5)), ['hooks_callback_legacy'])
+        self.assertFalse(Callback.objects.filter(id=old.id).exists())
+        self.assertTrue(Callback.objects.filter(id=new.id).exists())
+        self.assertGreater(self.create_callback().id, new.id)
+
+
+
+class MonitorCallbacksTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.hook = create_hook(signals=['django.db.models.signals.post_save'], model='modela', name='monitored hook')
+        cls.other_hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelb', name='other hook')
+        for hook, status, amount in ((cls.hook, 'waiting', 3), (cls.hook, 'sent', 8), (cls.hook, 'error', 2), (cls.other_hook, 'sent', 1)):
+            for i in range(amount):
+                Callback.objects.create(hook=hook, target_url=hook.target_url, status=status)
+        oldest = Callback.objects.filter(hook=cls.hook, status='waiting').first()
+        Callback.objects.filter(id=oldest.id).update(create_datetime=timezone.now() - timedelta(minutes=10))
+
+    def monitor(self, **options):
+        out = StringIO()
+        call_command('monitor_callbacks', stdout=out, **options)
+        return out.getvalue()
+
+
+    def test_callback_stats(self):
+        '''test that the statistics of all hooks are computed by a single query'''
+        with self.assertNumQueries(1):
+            stats = get_callback_stats()
+        self.assertEqual([s['hook'] for s in stats], ['monitored hook', 'other hook'])
+        self.assertEqual(stats[0]['counts'], {'waiting': 3, 'sent': 8, 'error': 2})
+        self.assertAlmostEqual(stats[0]['error_rate'], 0.2)
+        self.assertGreaterEqual(stats[0]['oldest_waiting_age'], 600)
+        self.assertEqual((stats[1]['error_rate'], stats[1]['oldest_waiting_age']), (0, None))
+
+
+    def test_monitor_output(self):
+        '''test the JSON and Prometheus outputs of monitor_callbacks'''
+        output = json.loads(self.monitor(format='json'))
+        self.assertEqual(output['totals']['counts'], {'waiting': 3, 'sent': 9, 'error': 2})
+        self.assertEqual(output['violations'], [])
+        output = self.monitor(format='prometheus')
+        self.assertIn('django_http_hooks_callbacks{{hook="monitored hook",hook_id="{}",status="error"}} 2\n'.format(self.hook.id), output)
+        self.assertIn('# TYPE django_http_hooks_oldest_waiting_seconds gauge', output)
+
+
+    def test_monitor_thresholds(self):
+        '''test that monitor_callbacks exits with status 1 when the callbacks exceed the global or the per-hook thresholds'''
+        self.monitor(status='waiting', callbacks_limit=4, max_waiting=3, max_waiting_age=700)
+        for options in (dict(status='waiting', callbacks_limit=3), dict(max_waiting=2), dict(max_waiting_age=300), dict(max_error_rate=0.1)):
+            with self.assertRaises(SystemExit):
+                self.monitor(**options)
+
+        with override_settings(DJANGO_HTTP_HOOKS_MONITOR_THRESHOLDS={'other hook': {'max_error_rate': 0.5}, '*': {'max_error_rate': 0.1}}):
+            with self.assertRaises(SystemExit), self.assertLogs('infi.django_http_hooks.hooks.management.commands.monitor_callbacks', level='WARNING') as logs:
+                self.monitor()
+        self.assertEqual(logs.output, ['WARNING:infi.django_http_hooks.hooks.management.commands.monitor_callbacks:'
+                                       'Hook monitored hook: error rate 20.0%, more than 10.0%'])
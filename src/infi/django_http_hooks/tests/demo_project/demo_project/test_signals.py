@@ -1,19 +1,527 @@
 import json
+from unittest import mock
+from unittest import skipIf
+from django.core import serializers
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from datetime import timedelta
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.db import IntegrityError
-from django.test import TestCase
+from django.template import TemplateSyntaxError
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
 from infi.django_http_hooks.hooks.models import Hook, Callback
 from infi.django_http_hooks.http_requests import send_request
 from infi.django_http_hooks.tests.wsgi_server import runserver
 from infi.django_http_hooks.exceptions import *
-from infi.django_http_hooks.api import create_hook, init
+from infi.django_http_hooks.api import create_hook, init, emit_hook_events
+from infi.django_http_hooks.utils import collect_callbacks, set_payload, get_sample_instance
+from infi.django_http_hooks.hooks import signals
+from infi.django_http_hooks.metrics import get_metrics, metrics_view, NullMetrics, PrometheusMetrics
 from demo_app.models import ModelA, ModelB, ModelC, ModelD, ModelE, ModelF, ModelG
 from django.dispatch.dispatcher import Signal as django_signal
 
 custom_signal = django_signal(providing_args=['instance'], use_caching=False)
 
 
+class BulkCallbacksTestCase(TestCase):
+
+    # testing the creation of callbacks in bulk
+
+    def setUp(self):
+        self.hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelg', name='bulk hook')
+        signals.init_hooks()
+
+    def tearDown(self):
+        # the hook is rolled back, so remove it from memory as well
+        signals.hooks = {}
+
+
+    def test_collect_callbacks(self):
+        '''test that callbacks created inside collect_callbacks are inserted together when the block exits'''
+        with collect_callbacks():
+            for i in range(3):
+                ModelG(name='G{}'.format(i)).save()
+            self.assertFalse(Callback.objects.filter(hook=self.hook))
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='waiting').count(), 3)
+
+
+    def test_collect_callbacks_with_error(self):
+        '''test that callbacks of a failed block are not inserted while its transaction is not committed'''
+        try:
+            with collect_callbacks():
+                ModelG(name='G').save()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(Callback.objects.filter(hook=self.hook))
+
+
+    def test_emit_hook_events(self):
+        '''test that hook events of bulk created instances are inserted in a single query'''
+        ModelG.objects.bulk_create([ModelG(name='G{}'.format(i)) for i in range(5)])
+        instances = list(ModelG.objects.all())
+        with self.assertNumQueries(1):
+            emit_hook_events(instances, created=True)
+
+        callbacks = Callback.objects.filter(hook=self.hook)
+        self.assertEqual(callbacks.count(), 5)
+        self.assertEqual({json.loads(c.payload)['object_id'] for c in callbacks}, {i.id for i in instances})
+        self.assertTrue(all(json.loads(c.payload)['event_type'] == 'created' for c in callbacks))
+
+
+class CollectCallbacksErrorTestCase(TransactionTestCase):
+
+    # testing the callbacks of a failed collect_callbacks block, which depend on whether the saved instances are committed
+
+    def setUp(self):
+        self.hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelg', name='collect errors hook')
+        # the hooks committed by SignalsTestCase, including an invalid serializer class, are kept until the database is flushed
+        with override_settings(DJANGO_HTTP_HOOKS_RAISE_EXCEPTIONS=False):
+            signals.init_hooks()
+
+    def tearDown(self):
+        signals.hooks = {}
+
+    def save_and_fail(self, *names):
+        try:
+            with collect_callbacks():
+                for name in names:
+                    ModelG(name=name).save()
+                raise ValueError()
+        except ValueError:
+            pass
+
+
+    def test_collect_callbacks_with_error(self):
+        '''test that callbacks of committed instances are inserted also when the block fails, and dropped when they are rolled back'''
+        # in autocommit mode the instances are committed as soon as they are saved
+        self.save_and_fail('G1', 'G2')
+        self.assertEqual(Callback.objects.filter(hook=self.hook).count(), 2)
+
+        with transaction.atomic():
+            self.save_and_fail('G3')
+            self.assertEqual(Callback.objects.filter(hook=self.hook).count(), 2)
+        self.assertEqual(Callback.objects.filter(hook=self.hook).count(), 3)
+
+        try:
+            with transaction.atomic():
+                self.save_and_fail('G4')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(Callback.objects.filter(hook=self.hook).count(), 3)
+        names = [json.loads(c.payload)['object_serialization']['name'] for c in Callback.objects.filter(hook=self.hook)]
+        self.assertEqual(sorted(names), ['G1', 'G2', 'G3'])
+
+
+@override_settings(DJANGO_HTTP_HOOKS_METRICS='prometheus')
+class MetricsTestCase(TestCase):
+
+    # testing the metrics of handling events and creating callbacks
+
+    def setUp(self):
+        self.hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelg', name='metrics hook')
+        signals.init_hooks()
+
+    def tearDown(self):
+        signals.hooks = {}
+
+
+    def test_event_metrics(self):
+        '''test that handled events, payload rendering and callback inserts are measured'''
+        ModelG(name='G').save()
+        with collect_callbacks():
+            for i in range(3):
+                ModelG(name='G{}'.format(i)).save()
+
+        metrics = get_metrics()
+        self.assertIsInstance(metrics, PrometheusMetrics)
+        signal_name = 'django.db.models.signals.post_save'
+        self.assertEqual(metrics.get('django_http_hooks_events_total', signal=signal_name), 4)
+        self.assertEqual(metrics.get('django_http_hooks_handler_seconds', signal=signal_name), 4)
+        self.assertEqual(metrics.get('django_http_hooks_payload_render_seconds', kind='default'), 4)
+        self.assertEqual(metrics.get('django_http_hooks_callbacks_inserted_total', mode='single'), 1)
+        self.assertEqual(metrics.get('django_http_hooks_callbacks_inserted_total', mode='bulk'), 3)
+        self.assertEqual(metrics.get('django_http_hooks_callback_insert_seconds', mode='bulk'), 1)
+
+
+    def test_metrics_view(self):
+        '''test that the view renders the metrics and the queue depth in the Prometheus text format'''
+        ModelG(name='G').save()
+        response = metrics_view(None)
+        text = response.content.decode('utf-8')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE django_http_hooks_payload_render_seconds histogram', text)
+        self.assertIn('django_http_hooks_payload_render_seconds_bucket{kind="default",le="+Inf"} 1', text)
+        self.assertIn('django_http_hooks_payload_render_seconds_count{kind="default"} 1', text)
+        self.assertIn('django_http_hooks_queue_depth{status="waiting"} 1', text)
+        self.assertNotIn('django_http_hooks_queue_depth{status="sent"}', text)
+
+
+    def test_metrics_off(self):
+        '''test that no metrics are kept by default'''
+        with override_settings(DJANGO_HTTP_HOOKS_METRICS=None):
+            self.assertIs(type(get_metrics()), NullMetrics)
+            ModelG(name='G').save()
+            self.assertIsNone(get_metrics().render())
+
+
+@override_settings(DJANGO_HTTP_HOOKS_ON_COMMIT=True)
+class OnCommitCallbacksTestCase(TransactionTestCase):
+
+    # testing that callbacks are created only after the transaction which triggered them is committed
+
+    def setUp(self):
+        self.hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelg', name='on commit hook')
+        # the hooks committed by SignalsTestCase, including an invalid serializer class, are kept until the database is flushed
+        with override_settings(DJANGO_HTTP_HOOKS_RAISE_EXCEPTIONS=False):
+            signals.init_hooks()
+
+    def tearDown(self):
+        signals.hooks = {}
+
+
+    def test_callbacks_created_on_commit(self):
+        '''test that callbacks are created only once the transaction is committed'''
+        with transaction.atomic():
+            for i in range(3):
+                ModelG(name='G{}'.format(i)).save()
+            self.assertFalse(Callback.objects.filter(hook=self.hook))
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='waiting').count(), 3)
+
+
+    def test_no_callbacks_on_rollback(self):
+        '''test that a rolled back transaction creates no callbacks, also when rolling back only a savepoint'''
+        try:
+            with transaction.atomic():
+                ModelG(name='G').save()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(Callback.objects.filter(hook=self.hook))
+
+        with transaction.atomic():
+            ModelG(name='G1').save()
+            try:
+                with transaction.atomic():
+                    ModelG(name='G2').save()
+                    raise ValueError()
+            except ValueError:
+                pass
+            ModelG(name='G3').save()
+        names = [json.loads(c.payload)['object_serialization']['name'] for c in Callback.objects.filter(hook=self.hook)]
+        self.assertEqual(sorted(names), ['G1', 'G3'])
+
+
+    def test_invalid_hook_on_commit(self):
+        '''test that an invalid hook does not fail the committed transaction, nor drop the callbacks of the other hooks'''
+        invalid_hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelg', name='invalid template hook')
+        Hook.objects.filter(id=invalid_hook.id).update(payload_template='{% bogus %}')
+        with override_settings(DJANGO_HTTP_HOOKS_RAISE_EXCEPTIONS=False):
+            signals.init_hooks()
+            with transaction.atomic():
+                ModelG(name='G').save()
+        self.assertTrue(ModelG.objects.filter(name='G').exists())
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='waiting').count(), 1)
+        self.assertFalse(Callback.objects.filter(hook=invalid_hook))
+
+        # the demo project raises exceptions, once the callbacks of the other hooks are inserted
+        with self.assertRaises(TemplateSyntaxError):
+            with transaction.atomic():
+                ModelG(name='G2').save()
+                ModelG(name='G3').save()
+        self.assertEqual(Callback.objects.filter(hook=self.hook, status='waiting').count(), 3)
+        self.assertFalse(Callback.objects.filter(hook=invalid_hook))
+
+
+    def test_callbacks_without_transaction(self):
+        '''test that a callback is created immediately in autocommit mode'''
+        ModelG(name='G').save()
+        self.assertEqual(Callback.objects.filter(hook=self.hook).count(), 1)
+
+
+class CompiledHooksTestCase(TestCase):
+
+    # testing that the parts of an hook used on each event are resolved once, when hooks are initialized
+
+    def tearDown(self):
+        signals.hooks = {}
+
+
+    def test_serializer_resolved_once(self):
+        '''test that the serializer class is imported when hooks are initialized and not on each event'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'],
+                           model='modelg',
+                           serializer_class='demo_app.serializers.NameSerializer')
+        signals.init_hooks()
+        with mock.patch('infi.django_http_hooks.utils.import_module') as import_module:
+            for i in range(3):
+                ModelG(name='G{}'.format(i)).save()
+            self.assertFalse(import_module.called)
+        payloads = [json.loads(c.payload) for c in Callback.objects.filter(hook=hook).order_by('id')]
+        self.assertEqual(payloads, [{'name': 'G0'}, {'name': 'G1'}, {'name': 'G2'}])
+
+
+    def test_invalid_serializer_validation(self):
+        '''test that an hook with a serializer class which cannot be imported is rejected by its validation'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'],
+                           model='modelg',
+                           target_url='http://127.0.0.1:8080',
+                           serializer_class='demo_app.serializers.Dummy')
+        with self.assertRaises(ValidationError):
+            hook.full_clean()
+        hook.serializer_class = 'demo_app.serializers.NameSerializer'
+        hook.full_clean()
+
+
+    def test_invalid_serializer_init(self):
+        '''test that an hook with a serializer class which cannot be imported fails initializing the hooks when exceptions are raised'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'],
+                           model='modelg',
+                           serializer_class='demo_app.serializers.Dummy')
+        # the demo project raises exceptions
+        with self.assertRaises(InvalidPayloadError):
+            signals.init_hooks()
+        with override_settings(DJANGO_HTTP_HOOKS_RAISE_EXCEPTIONS=False):
+            self.assertEqual(signals.init_hooks()['modelg_django.db.models.signals.post_save'], [hook])
+
+
+def serialize_default_payload(instance, event_type):
+    '''the default payload as it was built before set_payload serialized instances directly'''
+    object_serialization = json.loads(serializers.serialize('json', [instance])[1:-1])
+    return json.dumps({
+        'object_type': object_serialization.get('model'),
+        'object_id': object_serialization.get('pk'),
+        'event_type': event_type,
+        'object_serialization': object_serialization.get('fields')
+    })
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class DefaultPayloadTestCase(TestCase):
+
+    # testing the default payload, for hooks without payload_template and serializer_class
+
+    def setUp(self):
+        self.hook = create_hook(signals=['django.db.models.signals.post_save'], model='user', content_type='application/json')
+
+
+    def test_default_payload_identical_to_serializers(self):
+        '''test that the default payload is identical to the payload built by django.core.serializers'''
+        group = Group.objects.create(name='group')
+        user = User.objects.create(username='default', password='1234', first_name=u'\u05d0', last_login=timezone.now())
+        user.groups.add(group)
+        user.user_permissions.add(*Permission.objects.all()[:2])
+
+        for instance in [user, group, ModelA.objects.create(name='A'), ModelA(name='unsaved')]:
+            self.assertEqual(set_payload(self.hook, instance=instance, event_type='created'),
+                             serialize_default_payload(instance, 'created'))
+
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_backend(self):
+        '''test that the orjson backend dumps the same payload'''
+        user = User.objects.create(username='default', password='1234', last_login=timezone.now())
+        with override_settings(DJANGO_HTTP_HOOKS_JSON_BACKEND='orjson'):
+            payload = set_payload(self.hook, instance=user, event_type='updated')
+        expected = json.loads(serialize_default_payload(user, 'updated'))
+        payload = json.loads(payload)
+        # orjson dumps dates with full microseconds
+        self.assertEqual(payload['object_serialization'].pop('last_login')[:23], expected['object_serialization'].pop('last_login')[:23])
+        self.assertEqual(payload['object_serialization'].pop('date_joined')[:23], expected['object_serialization'].pop('date_joined')[:23])
+        self.assertEqual(payload, expected)
+
+
+class PayloadValidationTestCase(TestCase):
+
+    # testing the payload validation policies of hooks
+
+    def test_trusted_payload_not_validated(self):
+        '''test that default JSON payloads are not parsed again for validation'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'], model='modela', content_type='application/json')
+        with mock.patch('infi.django_http_hooks.utils.validate_payload') as validate_payload:
+            set_payload(hook, instance=ModelA.objects.create(name='A'), event_type='created')
+        self.assertFalse(validate_payload.called)
+
+
+    def test_validate_on_save(self):
+        '''test that payload templates of hooks validated on save are validated when the hook is cleaned, and not on each event'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'],
+                           model='modela',
+                           target_url='http://127.0.0.1:8080',
+                           content_type='application/json',
+                           payload_validation='on_save',
+                           payload_template='{"id": {{instance.id}} }')
+        # payload template is missing a bracket "{":
+        hook.payload_template = '"id": {{instance.id}} }'
+        hook.save()
+        instance = ModelA.objects.create(name='A')
+        self.assertEqual(set_payload(hook, instance=instance, event_type='created'), '"id": {} }}'.format(instance.id))
+
+        with self.assertRaises(ValidationError) as e:
+            hook.full_clean()
+        self.assertIn('payload_template', e.exception.message_dict)
+        hook.payload_template = '{"id": {{instance.id}} }'
+        hook.full_clean()
+
+
+    def test_validate_on_save_without_form(self):
+        '''test that payload templates of hooks validated on save are validated by create_hook, also when the model has no instances'''
+        self.assertFalse(ModelA.objects.exists())
+        with self.assertRaises(ValidationError):
+            create_hook(signals=['django.db.models.signals.post_save'],
+                        model='modela',
+                        content_type='application/json',
+                        payload_validation='on_save',
+                        payload_template='"id": {{instance.id}} }')
+        with self.assertRaises(ValidationError):
+            create_hook(signals=['django.db.models.signals.post_save'], model='modela', payload_validation='on_save', payload_template='{% bogus %}')
+        create_hook(signals=['django.db.models.signals.post_save'],
+                    model='modela',
+                    content_type='application/json',
+                    payload_validation='on_save',
+                    payload_template='{"id": {{instance.id}}, "name": "{{instance.name}}", "event": "{{event_type}}"}')
+        self.assertFalse(ModelA.objects.exists())
+
+
+    def test_sample_instance(self):
+        '''test that the sample instance of a model has values of the types of its fields, and is not saved'''
+        instance = get_sample_instance(Callback)
+        self.assertTrue(instance._state.adding)
+        # the default of a field is kept
+        self.assertEqual((instance.id, instance.attempts, instance.status), (1, 0, 'waiting'))
+        self.assertIsNotNone(instance.create_datetime)
+        self.assertIsNone(instance.hook_id)
+
+
+    def test_validate_sample(self):
+        '''test that only the given percent of payloads is validated'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'],
+                           model='modela',
+                           content_type='application/json',
+                           payload_validation='sample',
+                           payload_validation_sample_rate=30,
+                           payload_template='"id": {{instance.id}} }')
+        instance = ModelA.objects.create(name='A')
+        with mock.patch('random.random', return_value=0.5):
+            set_payload(hook, instance=instance, event_type='created')
+        with mock.patch('random.random', return_value=0.2):
+            with self.assertRaises(InvalidPayloadError):
+                set_payload(hook, instance=instance, event_type='created')
+
+
+class CoalesceCallbacksTestCase(TestCase):
+
+    # testing that rapid successive events of the same object are collapsed into one callback
+
+    def setUp(self):
+        self.hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelg', name='coalesce hook', coalesce_window=60)
+        signals.init_hooks()
+
+    def tearDown(self):
+        signals.hooks = {}
+
+    def get_names(self):
+        return [json.loads(c.payload)['object_serialization']['name'] for c in Callback.objects.filter(hook=self.hook).order_by('id')]
+
+
+    def test_coalesce_callbacks(self):
+        '''test that saving an object several times keeps a single waiting callback with the latest payload'''
+        G = ModelG.objects.create(name='G1')
+        other = ModelG.objects.create(name='other')
+        for name in ['G2', 'G3']:
+            G.name = name
+            G.save()
+        self.assertEqual(self.get_names(), ['G3', 'other'])
+        self.assertEqual(Callback.objects.get(hook=self.hook, object_id=str(G.id)).status, 'waiting')
+
+
+    def test_coalesce_outside_window(self):
+        '''test that callbacks which were sent or created before the coalesce window are not updated'''
+        G = ModelG.objects.create(name='G1')
+        Callback.objects.filter(hook=self.hook).update(create_datetime=timezone.now() - timedelta(seconds=61))
+        G.name = 'G2'
+        G.save()
+        Callback.objects.filter(hook=self.hook, object_id=str(G.id)).update(status='sent')
+        G.name = 'G3'
+        G.save()
+        self.assertEqual(self.get_names(), ['G1', 'G2', 'G3'])
+
+
+    def test_coalesce_collected_callbacks(self):
+        '''test that callbacks inserted in bulk are collapsed as well'''
+        G = ModelG.objects.create(name='G1')
+        with collect_callbacks():
+            for name in ['G2', 'G3']:
+                G.name = name
+                G.save()
+            ModelG.objects.create(name='other')
+        self.assertEqual(self.get_names(), ['G3', 'other'])
+
+
+class HooksReloadTestCase(TestCase):
+
+    # testing that changes in hooks take effect without restarting the server
+
+    @override_settings(DJANGO_HTTP_HOOKS_LIVE_RELOAD=True)
+    def test_live_reload(self):
+        '''test that reloading hooks connects and disconnects only the receivers of changed hooks'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelg', name='reload hook')
+        signals.reload_hooks()
+        self.assertIn('modelg_django.db.models.signals.post_save', signals.receivers)
+        ModelG(name='G').save()
+        self.assertEqual(Callback.objects.filter(hook=hook).count(), 1)
+
+        hook.enabled = False
+        hook.save()
+        signals.reload_hooks()
+        self.assertNotIn('modelg_django.db.models.signals.post_save', signals.receivers)
+        ModelG(name='G').save()
+        self.assertEqual(Callback.objects.filter(hook=hook).count(), 1)
+
+
+    def test_reload_by_version(self):
+        '''test that hooks changed by another process are reloaded on the next signal, using cache or db version'''
+        for backend in ('cache', 'db'):
+            with override_settings(DJANGO_HTTP_HOOKS_VERSION_BACKEND=backend):
+                hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelg', name='reload hook')
+                signals.init_hooks()
+
+                # another process disables the hook and bumps the version
+                hook.enabled = False
+                hook.save()
+                signals.bump_hooks_version()
+
+                with override_settings(DJANGO_HTTP_HOOKS_LIVE_RELOAD=True, DJANGO_HTTP_HOOKS_VERSION_CHECK_INTERVAL=0):
+                    ModelG(name='G').save()
+                self.assertFalse(Callback.objects.filter(hook=hook))
+                self.assertEqual(signals.hooks_version, signals.get_hooks_version())
+
+
+    @override_settings(DJANGO_HTTP_HOOKS_VERSION_BACKEND='db')
+    def test_version_check_interval(self):
+        '''test that the shared version is not read again before the check interval passes'''
+        hook = create_hook(signals=['django.db.models.signals.post_save'], model='modelg', name='reload hook')
+        signals.init_hooks()
+        hook.enabled = False
+        hook.save()
+        signals.bump_hooks_version()
+
+        with override_settings(DJANGO_HTTP_HOOKS_LIVE_RELOAD=True, DJANGO_HTTP_HOOKS_VERSION_CHECK_INTERVAL=60):
+            # one query for saving the model and one for inserting the callback, without reading the version
+            with self.assertNumQueries(2):
+                ModelG(name='G').save()
+        self.assertEqual(Callback.objects.filter(hook=hook).count(), 1)
+        signals.init_hooks()
+
+
 class SignalsTestCase(TestCase):
 
     # testing a case of signals based on changes in the Django User & Group models
@@ -333,7 +841,9 @@ class SignalsTestCase(TestCase):
                                              enabled=False
                                              )
 
-        registered_hooks = init()
+        # the hook with the dummy serializer would fail initializing the hooks
+        with override_settings(DJANGO_HTTP_HOOKS_RAISE_EXCEPTIONS=False):
+            registered_hooks = init()
         # test that init_hooks created hooks
         assert len(registered_hooks.keys()) == 11
         assert sum([len(v) for v in registered_hooks.values()]) == 12
\ No newline at end of file
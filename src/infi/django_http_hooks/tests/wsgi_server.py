@@ -1,3 +1,4 @@
+import gevent
 from gevent import pywsgi
 import json
 
@@ -27,14 +28,19 @@ def process_request(environ, start_response):
     response_body = json.dumps(body)
     response = dict(code='200 Accepted',
                     body=response_body)
+    # the test-delay and test-status headers let tests simulate slow and failing receivers
+    if environ.get('HTTP_TEST_DELAY'):
+        gevent.sleep(float(environ['HTTP_TEST_DELAY']))
+    if environ.get('HTTP_TEST_STATUS'):
+        response['code'] = '{} Test Status'.format(environ['HTTP_TEST_STATUS'])
 
     start_response(response['code'], HEADERS)
 
     return [response['body'].encode()]
 
 
-def runserver():
-    server = pywsgi.WSGIServer(('127.0.0.1', 8080), process_request)
+def runserver(port=8080):
+    server = pywsgi.WSGIServer(('127.0.0.1', port), process_request)
     server.serve_forever()
 
 
@@ -1,22 +1,132 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
 from django.utils import timezone
+from django.db import models, transaction, DEFAULT_DB_ALIAS
 from django.template import Template, Context
-from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import is_protected_type
 from infi.django_http_hooks.hooks.models import Callback
+from infi.django_http_hooks.metrics import get_metrics
 from .exceptions import *
 from importlib import import_module
+import threading
+import hashlib
+import random
 import logging
 import json
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TEMPLATE_CACHE_SIZE = 256
+
+# the fields serialized by the default payload of each model, see get_field_plan
+_field_plans = {}
+
+_json_encoder = DjangoJSONEncoder()
+
+# holds the callbacks buffered by the current thread inside collect_callbacks(), and the events queued by create_callback_on_commit()
+_local = threading.local()
+
+
+class TemplateCache(object):
+    '''
+    LRU cache of compiled payload templates, by hook id and the hash of the template text.
+    Changing the template of an hook changes its key, so a stale template is never used
+    '''
+
+    def __init__(self, max_size=DEFAULT_TEMPLATE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, hook):
+        key = (hook.id, hashlib.sha1(hook.payload_template.encode('utf-8')).hexdigest())
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return template
+            self.misses += 1
+
+        template = Template(hook.payload_template)
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def info(self):
+        '''returns the size and the hit rate of the cache'''
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=float(self.hits) / lookups if lookups else 0.0,
+                    size=len(self._templates),
+                    max_size=self.max_size)
+
+
+# compiled payload templates, cleared whenever the hooks are reloaded
+template_cache = TemplateCache(getattr(settings, 'DJANGO_HTTP_HOOKS_TEMPLATE_CACHE_SIZE', DEFAULT_TEMPLATE_CACHE_SIZE))
+
+
+class CompiledHook(object):
+    '''The parts of an hook which are resolved once, when hooks are initialized, instead of on each event'''
+
+    def __init__(self, hook):
+        self.serializer = None
+        self.serializer_error = None
+        if hook.serializer_class:
+            # serializer_class is expected to be a comma separated string: <path.to.serializer_class>
+            try:
+                self.serializer = import_path(hook.serializer_class)
+            except ImportError as e:
+                self.serializer_error = 'cannot import serializer class {}: {}'.format(hook.serializer_class, e)
+
+
+def compile_hook(hook):
+    '''resolve the parts of the given hook which are used on each event, and keep them on the hook object'''
+    hook._compiled = CompiledHook(hook)
+    return hook._compiled
+
+
+def get_compiled_hook(hook):
+    return hook.__dict__.get('_compiled') or compile_hook(hook)
+
 
 def create_callback(hook, **kwargs):
     '''
-    Create a new callback to be sent by background process
+    Create a new callback to be sent by background process.
+    Inside collect_callbacks() the callback is buffered and inserted together with the other callbacks of the block
     :param hook: Hook object
     :param kwargs: Contains instance and other inputs came from the signal
     :return:
     '''
+    callback = build_callback(hook, **kwargs)
+
+    buffered_callbacks = getattr(_local, 'callbacks', None)
+    if buffered_callbacks is not None:
+        buffered_callbacks.append(callback)
+    elif coalesce_callbacks([callback]):
+        metrics = get_metrics()
+        with metrics.timer('django_http_hooks_callback_insert_seconds', mode='single'):
+            callback.save()
+        metrics.inc('django_http_hooks_callbacks_inserted_total', mode='single')
+
+    return callback
+
+
+def build_callback(hook, **kwargs):
+    '''Create a new callback object without saving it'''
     now_ = timezone.now()
     try:
         callback = Callback(update_datetime = now_,
@@ -25,6 +135,9 @@ def create_callback(hook, **kwargs):
                             http_method     = hook.http_method,
                             content_type    = hook.content_type,
                             hook            = hook)
+        instance = kwargs.get('instance')
+        if instance is not None and instance.pk is not None:
+            callback.object_id = str(instance.pk)
 
         callback.payload = set_payload(hook, **kwargs)
         callback.headers = validate_headers(hook.headers) if hook.headers else hook.headers
@@ -33,11 +146,150 @@ def create_callback(hook, **kwargs):
         callback.status = 'error'
         callback.status_details = str(e)
 
-    callback.save()
-
     return callback
 
 
+@contextmanager
+def collect_callbacks(batch_size=500):
+    '''
+    Buffer the callbacks created inside the block and insert them with bulk_create when the block exits, e.g:
+
+    with collect_callbacks():
+        for instance in instances:
+            instance.save()
+
+    If the block raises an exception, the instances saved before it may already be committed (e.g. in autocommit mode), so their callbacks
+    are still inserted. Inside a transaction, they are inserted only once the transaction is committed, and dropped if it is rolled back.
+    Nested blocks are inserted by the outermost block.
+    '''
+    if getattr(_local, 'callbacks', None) is not None:
+        yield
+        return
+    _local.callbacks = callbacks = []
+    try:
+        yield
+    except Exception:
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: insert_callbacks(callbacks, batch_size))
+        else:
+            try:
+                insert_callbacks(callbacks, batch_size)
+            except Exception as e:
+                # the error of the block is more relevant to the caller
+                logger.error('Cannot insert the callbacks of a failed block: {}'.format(e))
+        raise
+    else:
+        insert_callbacks(callbacks, batch_size)
+    finally:
+        _local.callbacks = None
+
+
+def insert_callbacks(callbacks, batch_size=500):
+    '''insert the given new callbacks in bulk, after collapsing the ones of hooks with coalesce_window'''
+    callbacks = coalesce_callbacks(callbacks)
+    metrics = get_metrics()
+    with metrics.timer('django_http_hooks_callback_insert_seconds', mode='bulk'):
+        Callback.objects.bulk_create(callbacks, batch_size=batch_size)
+    metrics.inc('django_http_hooks_callbacks_inserted_total', len(callbacks), mode='bulk')
+
+
+def coalesce_callbacks(callbacks):
+    '''
+    Collapse the new waiting callbacks of hooks with coalesce_window which belong to the same hook and object:
+    only the latest one is kept, and if there is already a waiting callback of the same hook and object which was created
+    within the coalesce window, it is updated with the latest payload instead.
+    :param callbacks: New callbacks, which were not saved yet
+    :return: The callbacks which should still be inserted, in their original order
+    '''
+    latest = {}
+    for callback in callbacks:
+        key = _coalesce_key(callback)
+        if key is not None:
+            latest[key] = callback
+    if not latest:
+        return callbacks
+
+    now_ = timezone.now()
+    since = now_ - timedelta(seconds=max(c.hook.coalesce_window for c in latest.values()))
+    pending = Callback.objects.filter(status='waiting',
+                                      hook_id__in=set(key[0] for key in latest),
+                                      object_id__in=set(key[1] for key in latest),
+                                      create_datetime__gte=since) \
+                              .order_by('id').values_list('id', 'hook_id', 'object_id', 'create_datetime')
+    pending_ids = {}
+    for id_, hook_id, object_id, create_datetime in pending:
+        callback = latest.get((hook_id, object_id))
+        if callback is not None and create_datetime >= now_ - timedelta(seconds=callback.hook.coalesce_window):
+            pending_ids[(hook_id, object_id)] = id_
+
+    coalesced = set()
+    for key, callback in latest.items():
+        # the pending callback may have been claimed for sending meanwhile, then a new callback is inserted
+        if key in pending_ids and Callback.objects.filter(id=pending_ids[key], status='waiting') \
+                                                  .update(payload=callback.payload, headers=callback.headers, update_datetime=now_):
+            callback.id = pending_ids[key]
+            callback._state.adding = False
+            coalesced.add(key)
+
+    return [c for c in callbacks if _coalesce_key(c) is None or (latest[_coalesce_key(c)] is c and _coalesce_key(c) not in coalesced)]
+
+
+def _coalesce_key(callback):
+    '''returns the key of callbacks which can be collapsed together, or None if the callback cannot be collapsed'''
+    if callback.hook.coalesce_window and callback.object_id is not None and callback.status == 'waiting':
+        return callback.hook_id, callback.object_id
+    return None
+
+
+def create_callback_on_commit(hook, **kwargs):
+    '''
+    Queue the creation of a callback until the current transaction is committed.
+    All events queued in the same transaction are rendered and inserted together after the commit, and are dropped if the transaction is rolled back.
+    Outside of a transaction the callback is created immediately
+    :param hook: Hook object
+    :param kwargs: Contains instance and other inputs came from the signal
+    '''
+    using = kwargs.get('using') or DEFAULT_DB_ALIAS
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        return create_callback(hook, **kwargs)
+
+    # events of a savepoint are kept apart, so rolling back the savepoint drops only its own events
+    queue_key = (using, tuple(connection.savepoint_ids))
+    queues = getattr(_local, 'event_queues', None)
+    if queues is None:
+        queues = _local.event_queues = {}
+    queue = queues.get(queue_key)
+    # a queue whose flush is no longer registered belongs to a transaction (or savepoint) which was rolled back
+    if queue is None or not any(entry[1] is queue['flush'] for entry in connection.run_on_commit):
+        queue = queues[queue_key] = _create_event_queue(queues, queue_key)
+        transaction.on_commit(queue['flush'], using=using)
+    queue['events'].append((hook, kwargs))
+
+
+def _create_event_queue(queues, queue_key):
+    events = []
+
+    def flush():
+        if queues.get(queue_key) is queue:
+            del queues[queue_key]
+        error = None
+        with collect_callbacks():
+            for hook, kwargs in events:
+                # runs after the commit, outside of the signal handler, so an error of one hook must not drop the events of the other hooks
+                try:
+                    create_callback(hook, **kwargs)
+                except Exception as e:
+                    logger.error('Error in creating callback of hook {} on commit: {}'.format(hook.id, e))
+                    error = error or e
+        # raise the exception only if it was configured in the project's settings, once the other callbacks are inserted
+        if error is not None and hasattr(settings, 'DJANGO_HTTP_HOOKS_RAISE_EXCEPTIONS') and settings.DJANGO_HTTP_HOOKS_RAISE_EXCEPTIONS:
+            raise error
+
+    queue = dict(events=events, flush=flush)
+    return queue
+
+
 def validate_headers(headers):
     '''
     Expected headers is pair of values (key:value) separated by a new line e.g:
@@ -73,50 +325,147 @@ def validate_payload(payload, content_type):
             raise InvalidPayloadError('Payload is an invalid XML: {}'.format(payload))
 
 
+def should_validate_payload(hook, trusted):
+    '''
+    Payloads dumped by json.dumps (default payload or serializer_class) are trusted, and are valid JSON by construction.
+    Other payloads are validated according to the payload_validation policy of the hook
+    '''
+    if trusted and hook.content_type == 'application/json':
+        return False
+    if hook.payload_validation == 'on_save':
+        return False
+    if hook.payload_validation == 'sample':
+        return random.random() * 100 < hook.payload_validation_sample_rate
+    return True
+
+
 def set_payload(hook, **kwargs):
     '''Set the payload according to given payload_tamplate or serializer_class. If both are missing returns a default payload'''
+    trusted = not hook.payload_template
+    kind = 'template' if hook.payload_template else 'serializer' if hook.serializer_class else 'default'
+    with get_metrics().timer('django_http_hooks_payload_render_seconds', kind=kind):
+        payload = render_payload(hook, kind, **kwargs)
+
+    if should_validate_payload(hook, trusted):
+        validate_payload(payload, hook.content_type)
+    return payload
+
+
+def render_payload(hook, kind, **kwargs):
+    '''render the payload of the given kind: template, serializer or default'''
     instance = kwargs.get('instance')
-    # setting payload
-    if hook.payload_template:
+    if kind == 'template':
         context = dict(instance=instance)
         context.update(kwargs)
         c = Context(context)
-        template = Template(hook.payload_template)
+        template = template_cache.get(hook)
         payload = template.render(c)
 
-    elif hook.serializer_class:
-        # serializer_class is expected to be a comma separated string: <path.to.serializer_class>
-        serializer = dynamic_import(hook.serializer_class)
-        if not serializer:
-            logger.error('cannot import serializer class {}'.format(hook.serializer_class))
-            raise InvalidPayloadError('cannot import serializer class {}'.format(hook.serializer_class))
+    elif kind == 'serializer':
+        # the serializer class is imported once per hook, see CompiledHook
+        compiled = get_compiled_hook(hook)
+        if compiled.serializer_error:
+            logger.error(compiled.serializer_error)
+            raise InvalidPayloadError(compiled.serializer_error)
         try:
             # executes to_representation of the given serializer and dump it to json
-            payload = json.dumps(serializer().to_representation(instance))
+            payload = json.dumps(compiled.serializer().to_representation(instance))
         except Exception as e:
-            logger.error('cannot execute to_representation with the given serializer: {}'.format(e.message))
-            raise InvalidPayloadError('cannot execute to_representation with the given serializer: {}'.format(e.message))
+            logger.error('cannot execute to_representation with the given serializer: {}'.format(e))
+            raise InvalidPayloadError('cannot execute to_representation with the given serializer: {}'.format(e))
     else:
         # default payload
-        # convert the json list to dict: trim the '[' and ']' and load the json dict
-        object_serialization = json.loads(serializers.serialize('json', [instance])[1:-1])
-        payload = json.dumps({
-            # object_serialization['model'] contains the full path of the model
-            'object_type': object_serialization.get('model'),
-            'object_id': object_serialization.get('pk'),
+        payload = dumps({
+            # the full path of the model
+            'object_type': str(instance._meta),
+            'object_id': _field_value(instance, instance._meta.pk),
             'event_type': kwargs.get('event_type'),
-            'object_serialization': object_serialization.get('fields')
+            'object_serialization': serialize_instance(instance)
         })
-
-    validate_payload(payload, hook.content_type)
     return payload
 
 
+def import_path(package_path):
+    '''import the object of the given full path, e.g: path.to.module.object. Raises ImportError if it cannot be imported'''
+    module_path, _, name = package_path.rpartition('.')
+    if not module_path:
+        raise ImportError('{} is not a full path'.format(package_path))
+    module = import_module(module_path)
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise ImportError('module {} has no attribute {}'.format(module_path, name))
+
+
+def get_field_plan(model):
+    '''
+    returns the fields of the given model which are serialized by the default payload, as pairs of (field, is_many_to_many).
+    The fields are the same and in the same order as serialized by django.core.serializers
+    '''
+    plan = _field_plans.get(model)
+    if plan is None:
+        # use the concrete model for proxy models, same as django.core.serializers
+        concrete_model = model._meta.concrete_model
+        plan = [(field, False) for field in concrete_model._meta.local_fields if field.serialize]
+        plan += [(field, True) for field in concrete_model._meta.many_to_many
+                 if field.serialize and field.remote_field.through._meta.auto_created]
+        _field_plans[model] = plan
+    return plan
+
+
+def _field_value(instance, field):
+    value = field.value_from_object(instance)
+    # primitives like None, numbers, dates and Decimals are passed as is, all other values are converted to string
+    return value if is_protected_type(value) else field.value_to_string(instance)
+
+
+def serialize_instance(instance):
+    '''
+    returns a dict of the field values of the given instance, the same as the 'fields' of serializers.serialize('json', [instance])
+    without dumping it to JSON and loading it back
+    '''
+    fields = OrderedDict()
+    for field, many_to_many in get_field_plan(type(instance)):
+        if many_to_many:
+            fields[field.name] = [_field_value(related, related._meta.pk) for related in getattr(instance, field.name).iterator()]
+        else:
+            fields[field.name] = _field_value(instance, field)
+    return fields
+
+
+def get_sample_instance(model):
+    '''
+    returns an unsaved instance of the given model to render payload templates with, regardless of the rows of its table.
+    Its empty fields are given sample values of their types, e.g. so a template rendering a number does not render None
+    '''
+    instance = model()
+    now = timezone.now()
+    # the first matching type wins, so subclasses (e.g. DateTimeField of DateField) come first
+    samples = [((models.AutoField, models.IntegerField), 1), ((models.FloatField, ), 1.0), ((models.DecimalField, ), Decimal('1')),
+               ((models.BooleanField, ), True), ((models.DateTimeField, ), now), ((models.DateField, ), now.date()),
+               ((models.TimeField, ), now.time())]
+    for field in model._meta.concrete_fields:
+        if field.is_relation or getattr(instance, field.attname) is not None:
+            continue
+        for types, value in samples:
+            if isinstance(field, types):
+                setattr(instance, field.attname, value)
+                break
+    return instance
+
+def dumps(data):
+    '''
+    dump the default payload to JSON. Set DJANGO_HTTP_HOOKS_JSON_BACKEND = 'orjson' to use the faster orjson package,
+    which dumps compact JSON, and dates with full microseconds
+    '''
+    if getattr(settings, 'DJANGO_HTTP_HOOKS_JSON_BACKEND', 'json') == 'orjson':
+        import orjson
+        return orjson.dumps(data, default=_json_encoder.default).decode('utf-8')
+    return json.dumps(data, cls=DjangoJSONEncoder)
+
+
 def dynamic_import(package_path):
     try:
-        path_list = package_path.split('.')
-        module = import_module('.'.join(path_list[:-1]))
-        res = getattr(module, path_list[-1])
-        return res
+        return import_path(package_path)
     except Exception:
-        return None
\ No newline at end of file
+        return None